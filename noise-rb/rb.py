@@ -1,9 +1,8 @@
 # Import general libraries
 import time
 import math
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-from IPython import display
 
 # Import Qiskit classes
 import qiskit
@@ -13,10 +12,27 @@ from qiskit import QuantumCircuit, assemble, transpile, execute
 import qiskit.ignis.verification.randomized_benchmarking as rb
 
 
-def run_rb(nQ, nCliffs, pattern, len_multiplier, shots, nSeeds, backend, basis_gates):
+# Transpiled RB circuits keyed by (rand_seed, pattern, nCliffs, len_multiplier, basis_gates, seed)
+_transpile_cache = {}
+
+
+def _transpile_seed(rb_circ_seed, basis_gates):
+    # Module-level so that it can be dispatched to worker processes
+    return qiskit.transpile(rb_circ_seed, basis_gates=basis_gates)
+
+
+def _cache_transpiled(key, future):
+    if future.exception() is None:
+        _transpile_cache[key] = future.result()
+
+
+def run_rb(nQ, nCliffs, pattern, len_multiplier, shots, nSeeds, backend, basis_gates,
+           rand_seed=None, n_workers=None, asynchronous=False):
     """
     Generate single qubit RB circuits with input as specs.
     Note: if all qubits are benchmarked together, one can take into account possible crosstalks in the hardware.
+    Seeds are transpiled in parallel worker processes, and each seed is submitted as soon as it is transpiled,
+    so execution of seed k overlaps with transpilation of the following seeds.
 
     Parameters:
     nQ [int]: number of qubits intended for RB experiments
@@ -27,10 +43,13 @@ def run_rb(nQ, nCliffs, pattern, len_multiplier, shots, nSeeds, backend, basis_g
     nseeds [int]: number of different circuits per RB configuration
     backend: simulator/hardware to run RB experiment on
     basis_gates [list]: list of gates in string form (i.e. "cz", "rx" etc.) to decompose RB circuits in
+    rand_seed [int]: seed for generating RB sequences; transpiled sequences are only cached when it is given
+    n_workers [int]: number of transpilation processes, defaults to the number of cores
+    asynchronous [Bool]: Boolean value for deciding whether to return futures instead of waiting on submission
 
     Returns:
-    job_list [list]: list of Job Objects for RB simulations
-    transpile_list [list]: list of QuantumCircuit generated by RB experiments
+    job_list [list]: list of Job Objects for RB simulations (or futures thereof if asynchronous)
+    transpile_list [list]: list of QuantumCircuit generated by RB experiments (or futures thereof if asynchronous)
     xdata [list]: list of the form [[m, ...], [n, ...], ...], where each list in xdata specify a set of Clifford lengths
                   tested on the corresponding qubit(s) in RB
     """
@@ -47,72 +66,181 @@ def run_rb(nQ, nCliffs, pattern, len_multiplier, shots, nSeeds, backend, basis_g
     rb_opts['nseeds'] = nSeeds
     rb_opts['rb_pattern'] = pattern
     rb_opts['length_multiplier'] = len_multiplier
+    if rand_seed is not None:
+        rb_opts['rand_seed'] = rand_seed
     rb_circs, xdata = rb.randomized_benchmarking_seq(**rb_opts)
 
-    # Record job and circuit information for error rate calculation
-    job_list = []
-    transpile_list = []
+    # Transpile all seeds in parallel, reusing cached sequences where possible
+    cache_key = (rand_seed,
+                 tuple(tuple(qubits) for qubits in pattern),
+                 tuple(np.atleast_1d(nCliffs).tolist()),
+                 tuple(np.atleast_1d(len_multiplier).tolist()),
+                 tuple(basis_gates))
+    transpile_pool = ProcessPoolExecutor(max_workers=n_workers)
+    transpile_futures = []
     for rb_seed, rb_circ_seed in enumerate(rb_circs):
-        print('Compiling seed %d'%rb_seed)
-        rb_circ_transpile = qiskit.transpile(rb_circ_seed, basis_gates=basis_gates)
-        transpile_list.append(rb_circ_transpile)
+        seed_key = cache_key + (rb_seed,)
+        if rand_seed is not None and seed_key in _transpile_cache:
+            future = Future()
+            future.set_result(_transpile_cache[seed_key])
+        else:
+            print('Compiling seed %d'%rb_seed)
+            future = transpile_pool.submit(_transpile_seed, rb_circ_seed, basis_gates)
+            if rand_seed is not None:
+                future.add_done_callback(lambda f, k=seed_key: _cache_transpiled(k, f))
+        transpile_futures.append(future)
+    transpile_pool.shutdown(wait=False)
+
+    # Submit seeds in order as soon as each one has been transpiled
+    def submit(rb_seed):
+        rb_circ_transpile = transpile_futures[rb_seed].result()
         print('Submitting seed %d'%rb_seed)
-        job = qiskit.execute(rb_circ_transpile, shots=shots, backend=backend, backend_options={'max_parallel_experiments': 0})
-        job_list.append(job)
+        return qiskit.execute(rb_circ_transpile, shots=shots, backend=backend, backend_options={'max_parallel_experiments': 0})
+
+    submit_pool = ThreadPoolExecutor(max_workers=1)
+    job_futures = [submit_pool.submit(submit, rb_seed) for rb_seed in range(len(rb_circs))]
+    submit_pool.shutdown(wait=False)
+
+    if asynchronous:
+        return job_futures, transpile_futures, xdata
+
+    # Record job and circuit information for error rate calculation
+    job_list = [future.result() for future in job_futures]
+    transpile_list = [future.result() for future in transpile_futures]
     print("Finished Submission")
 
     return job_list, transpile_list, xdata
 
 
+def iter_rb_fits(result_list, pattern, xdata):
+    """
+    Fit RB results incrementally, adding one seed at a time to an RBFitter. Does not require a display.
+
+    parameters:
+    result_list [list]: list of QIResult that contains RB results, or RB data loaded by load_rb_data
+    pattern [list]: list of the form [[i,j], [k], ...], where i, j, k are qubit indices in simultaneous RB experiments
+    xdata [list]: list of the form [[m, ...], [n, ...], ...], where each list in xdata specify a set of Clifford lengths
+                  tested on the corresponding qubit(s) in RB
+
+    yields:
+    seed_num [int]: index of the last seed included in the fit
+    rbfit [RBFitter]: fitter over seeds 0 to seed_num
+    """
+    if hasattr(result_list, 'keys'):
+        # RB data loaded by load_rb_data is refitted from the stored survival probabilities
+        for seed_num in range(result_list['survival'].shape[1]):
+            yield seed_num, rb_fitter_from_data(result_list, n_seeds=seed_num+1)
+        return
+
+    rbfit = rb.fitters.RBFitter(None, xdata, pattern)
+    for seed_num, data in enumerate(result_list):
+        # Add another seed to the data
+        rbfit.add_data([data])
+        yield seed_num, rbfit
+
+
+def fit_rb(result_list, pattern, xdata, epc_rtol=None, min_seeds=2):
+    """
+    Fit RB results headlessly, stopping early once the EPC of every qubit pattern is known to within epc_rtol.
+
+    parameters:
+    result_list [list]: list of QIResult that contains RB results, or RB data loaded by load_rb_data
+    pattern [list]: list of the form [[i,j], [k], ...], where i, j, k are qubit indices in simultaneous RB experiments
+    xdata [list]: list of the form [[m, ...], [n, ...], ...], where each list in xdata specify a set of Clifford lengths
+                  tested on the corresponding qubit(s) in RB
+    epc_rtol [float]: relative EPC error (epc_err / epc) below which fitting stops; None to fit all seeds
+    min_seeds [int]: minimum number of seeds to fit before stopping early
+
+    returns:
+    rbfit [RBFitter]: fitter over the seeds used
+    history [dict]: arrays of the form [seed, pattern] for 'epc', 'epc_err', and [seed, pattern, 3] for 'params'
+    """
+    history = {'epc': [], 'epc_err': [], 'params': []}
+    rbfit = None
+    for seed_num, rbfit in iter_rb_fits(result_list, pattern, xdata):
+        fit = rbfit.fit
+        epc = np.array([f['epc'] for f in fit])
+        epc_err = np.array([f['epc_err'] for f in fit])
+        history['epc'].append(epc)
+        history['epc_err'].append(epc_err)
+        history['params'].append([f['params'] for f in fit])
+        if epc_rtol is not None and seed_num + 1 >= min_seeds and np.all(epc_err <= epc_rtol * epc):
+            break
+
+    return rbfit, {name: np.array(values, dtype=float) for name, values in history.items()}
+
+
+def plot_rb_fit(rbfit, pattern, seed_num=None):
+    """
+    Plot a fitted RBFitter, one panel per qubit pattern. Currently supports 1QB and 2QB RB plotting.
+
+    parameters:
+    rbfit [RBFitter]: fitter returned by fit_rb or iter_rb_fits
+    pattern [list]: list of the form [[i,j], [k], ...], where i, j, k are qubit indices in simultaneous RB experiments
+    seed_num [int]: index of the last fitted seed, shown in the panel titles if given
+
+    returns:
+    fig [Figure]: the matplotlib figure
+    """
+    import matplotlib.pyplot as plt
+
+    # Construct plots
+    fig = plt.figure(figsize=(22, 14))
+    axis = [plt.subplot(231), plt.subplot(232), plt.subplot(233), plt.subplot(234), plt.subplot(236)]
+
+    suffix = '' if seed_num is None else ' - after seed %d' % seed_num
+    # Iterate through all qubit patterns ran in the experiment
+    for i in range(len(pattern)):
+        pattern_ind = i
+        # Plot by plot_rb_data
+        rbfit.plot_rb_data(pattern_ind, ax=axis[i], add_label=True, show_plt=False)
+        # Add title and label
+        if len(pattern[i]) == 1:
+            axis[i].set_title('Qubit %d RB%s' % (pattern[i][0], suffix), fontsize=18)
+        elif len(pattern[i]) == 2:
+            axis[i].set_title('Qubit (%d, %d) RB%s' % (pattern[i][0], pattern[i][1], suffix), fontsize=18)
+
+    return fig
+
+
 def plot_rb(result_list, pattern, xdata, savedata=False, savefig=False):
     """
-    Plot/record RB results from experiments. Currently supports 1QB and 2QB RB plotting.
+    Plot/record RB results from experiments in a notebook, redrawing the fit after each seed.
+    Currently supports 1QB and 2QB RB plotting.
     Clifford length: number of clifford elements tested in RB experiments
     Ground state population: state fidelity after action by a number of cliffords in the circuit
     EPC: error per clifford
     alpha: fitting parameter
+    Use fit_rb and plot_rb_fit outside of notebooks.
 
     parameters:
-    result_list [list]: list of QIResult that contains RB results
+    result_list [list]: list of QIResult that contains RB results, or RB data loaded by load_rb_data
     pattern [list]: list of the form [[i,j], [k], ...], where i, j, k are qubit indices in simultaneous RB experiments
     xdata [list]: list of the form [[m, ...], [n, ...], ...], where each list in xdata specify a set of Clifford lengths
                   tested on the corresponding qubit(s) in RB
     savedata [Bool]: Boolean value for deciding whether to save the final round of RB fitting result
     savefig [Bool]: Boolean value for deciding whether to save the final round of plotted result
     """
-    # Construct the fitting function for the first set of RB result
-    rbfit = rb.fitters.RBFitter(result_list[0], xdata, pattern)
-    max_seed = len(result_list)-1
+    import matplotlib.pyplot as plt
+    from IPython import display
 
-    # Iterate through all RB experiments
-    for seed_num, data in enumerate(result_list):
-        # Construct plots
-        plt.figure(figsize=(22, 14))
-        axis = [plt.subplot(231), plt.subplot(232), plt.subplot(233), plt.subplot(234), plt.subplot(236)]
+    n_seeds = result_list['survival'].shape[1] if hasattr(result_list, 'keys') else len(result_list)
+    max_seed = n_seeds-1
 
-        # Add another seed to the data
-        rbfit.add_data([data])
-        # Iterate through all qubit patterns ran in the experiment
-        for i in range(len(pattern)):
-            pattern_ind = i
-            # Plot by plot_rb_data
-            rbfit.plot_rb_data(pattern_ind, ax=axis[i], add_label=True, show_plt=False)
-            # Add title and label
-            if len(pattern[i]) == 1:
-                axis[i].set_title('Qubit %d RB - after seed %d' % (pattern[i][0], seed_num), fontsize=18)
-            elif len(pattern[i]) == 2:
-                axis[i].set_title('Qubit (%d, %d) RB - after seed %d' % (pattern[i][0], pattern[i][1], seed_num), fontsize=18)
+    # Iterate through all RB experiments
+    for seed_num, rbfit in iter_rb_fits(result_list, pattern, xdata):
+        fig = plot_rb_fit(rbfit, pattern, seed_num)
 
         # Display
-        display.display(plt.gcf())
+        display.display(fig)
         # Save plot optionally
         if (seed_num == max_seed) and (savefig == True):
-            plt.savefig("rb-results.pdf")
+            fig.savefig("rb-results.pdf")
             # print("Saved RB plot.")
         # Clear display after each seed and close
         display.clear_output(wait=True)
         time.sleep(1.0)
-        plt.close()
+        plt.close(fig)
 
     # Save RB fit optionally
     if (savedata == True):
@@ -120,8 +248,121 @@ def plot_rb(result_list, pattern, xdata, savedata=False, savefig=False):
         return rbfit.fit
 
 
+def save_rb_data(path, result_list, pattern, xdata):
+    """
+    Save RB results as NumPy arrays in an uncompressed .npz file, which can be read back without unpickling job
+    objects or depending on the Qiskit version the results were produced with.
+
+    parameters:
+    path [str]: path of the .npz file to write
+    result_list [list]: list of QIResult that contains RB results
+    pattern [list]: list of the form [[i,j], [k], ...], where i, j, k are qubit indices in simultaneous RB experiments
+    xdata [list]: list of the form [[m, ...], [n, ...], ...], where each list in xdata specify a set of Clifford lengths
+                  tested on the corresponding qubit(s) in RB
+
+    Arrays written:
+    survival [nPatterns, nSeeds, nLengths]: ground state population of each pattern per seed and Clifford length
+    xdata [nPatterns, nLengths]: Clifford lengths
+    pattern_qubits, pattern_sizes: the qubit pattern flattened, with the number of qubits in each entry
+    fit_params, fit_params_err [nPatterns, 3]: fitted (A, alpha, B) and their errors
+    epc, epc_err [nPatterns]: error per Clifford and its error
+    """
+    rbfit = rb.fitters.RBFitter(result_list, xdata, pattern)
+    fit = rbfit.fit
+    np.savez(
+        path,
+        survival=np.asarray(rbfit.raw_data, dtype=float),
+        xdata=np.asarray(xdata),
+        pattern_qubits=np.concatenate([np.asarray(qubits, dtype=int) for qubits in pattern]),
+        pattern_sizes=np.array([len(qubits) for qubits in pattern], dtype=int),
+        fit_params=np.array([f['params'] for f in fit], dtype=float),
+        fit_params_err=np.array([f['params_err'] for f in fit], dtype=float),
+        epc=np.array([f['epc'] for f in fit], dtype=float),
+        epc_err=np.array([f['epc_err'] for f in fit], dtype=float))
+
+
+def load_rb_data(path):
+    """
+    Load RB data saved by save_rb_data. Arrays are read lazily on first access, so reading e.g. only the EPC of a
+    large calibration history does not load the survival data.
+
+    returns:
+    rb_data [NpzFile]: mapping of array names to arrays (see save_rb_data)
+    """
+    return np.load(path)
+
+
+def get_rb_pattern(rb_data):
+    """
+    Recover the qubit pattern of the form [[i,j], [k], ...] from RB data loaded by load_rb_data
+    """
+    bounds = np.cumsum(rb_data['pattern_sizes'])[:-1]
+    return [qubits.tolist() for qubits in np.split(rb_data['pattern_qubits'], bounds)]
+
 
-def get_gate_num(circuit_list, xdata, pattern, basis_gates):
+def rb_fitter_from_data(rb_data, n_seeds=None):
+    """
+    Construct an RBFitter from RB data loaded by load_rb_data, fitted over the first n_seeds seeds (all if None)
+    """
+    rbfit = rb.fitters.RBFitter(None, rb_data['xdata'], get_rb_pattern(rb_data))
+    # RBFitter only computes raw data from Result objects, so set the stored survival probabilities directly
+    # RBFitter.raw_data is indexed [pattern][seed][length]
+    rbfit._raw_data = rb_data['survival'][:, :n_seeds].tolist()
+    rbfit.calc_statistics()
+    rbfit.fit_data()
+    return rbfit
+
+
+def count_gates(circuit_list, xdata, pattern, basis_gates):
+    """
+    Count the basis gates acting on each qubit in the RB Clifford circuits in a single pass over all circuits
+
+    parameters:
+    circuit_list [list]: list of QuantumCircuit generated by RB experiments
+    xdata [list]: list of the form [[m, ...], [n, ...], ...], where each list in xdata specify a set of Clifford lengths
+                  tested on the corresponding qubit(s) in RB
+    pattern [list]: list of the form [[i,j], [k], ...], where i, j, k are qubit numbers in simultaneous RB experiments
+    basis_gates [list]: list of gates in string form (i.e. "cz", "rx" etc.) to decompose RB circuits in
+
+    return:
+    gate_counts [array]: array of shape (qubit, basis_gate, length) of gate counts summed over seeds
+    gates_per_cliff [array]: structured array of shape (qubit,) with one field per basis gate holding the average
+                             number of gates per Clifford, NaN for qubits not in the pattern
+    """
+    n_qubits = max(max(qubits) for qubits in pattern) + 1
+    n_gates = len(basis_gates)
+    n_lengths = len(xdata[0])
+    gate_index = {basis_gate: j for j, basis_gate in enumerate(basis_gates)}
+
+    # Collect flat (qubit, basis_gate, length) indices of every gate, then count them at once
+    flat_index = []
+    for seed_circuits in circuit_list:
+        for length_ind, circuit in enumerate(seed_circuits):
+            qubit_index = {qubit: i for i, qubit in enumerate(circuit.qubits)}
+            for instr, qargs, _ in circuit.data:
+                j = gate_index.get(instr.name)
+                if j is None:
+                    continue
+                for qubit in qargs:
+                    flat_index.append((qubit_index[qubit] * n_gates + j) * n_lengths + length_ind)
+    gate_counts = np.bincount(np.array(flat_index, dtype=np.int64),
+                              minlength=n_qubits * n_gates * n_lengths).reshape(n_qubits, n_gates, n_lengths)
+
+    # Normalise by the total number of Cliffords applied to each qubit's pattern over all seeds, counting the
+    # inverting Clifford at the end of every sequence as gates_per_clifford in ignis does
+    total_cliffs = np.full(n_qubits, np.nan)
+    for i, qubits in enumerate(pattern):
+        total_cliffs[qubits] = len(circuit_list) * np.sum(np.asarray(xdata[i]) + 1)
+    avg_gates = gate_counts.sum(axis=2) / total_cliffs[:, None]
+
+    gates_per_cliff = np.empty(n_qubits, dtype=[(basis_gate, float) for basis_gate in basis_gates])
+    for j, basis_gate in enumerate(basis_gates):
+        gates_per_cliff[basis_gate] = avg_gates[:, j]
+
+    return gate_counts, gates_per_cliff
+
+
+def get_gate_num(circuit_list, xdata, pattern, basis_gates, verbose=False):
     """
     Count the number of single or two-qubit gates in the RB Clifford circuits for a given qubit pattern
 
@@ -131,26 +372,23 @@ def get_gate_num(circuit_list, xdata, pattern, basis_gates):
                   tested on the corresponding qubit(s) in RB
     pattern [list]: list of the form [[i,j], [k], ...], where i, j, k are qubit numbers in simultaneous RB experiments
     basis_gates [list]: list of gates in string form (i.e. "cz", "rx" etc.) to decompose RB circuits in
+    verbose [Bool]: Boolean value for deciding whether to print the average gate numbers per pattern
 
     return:
     avg_gate_list [list]: list of gate numbers in basis gates for the given qubit pattern
     """
+    _, gates_per_cliff = count_gates(circuit_list, xdata, pattern, basis_gates)
+
     avg_gate_list = []
-    # Iterate through all qubits in the machine
-    for i in range(len(pattern)):
-        # Calculate average gate number per clifford
-        qubits = pattern[i]
-        gate_per_cliff = rb.rb_utils.gates_per_clifford(
-            transpiled_circuits_list=circuit_list,
-            clifford_lengths=xdata[i],
-            basis=basis_gates,
-            qubits=qubits)
-        avg_gate_list.append(gate_per_cliff)
+    for qubits in pattern:
+        avg_gate_list.append({qubit: {basis_gate: float(gates_per_cliff[basis_gate][qubit]) for basis_gate in basis_gates}
+                              for qubit in qubits})
 
         # Print results
-        print("Qubit(s):", qubits)
-        for basis_gate in basis_gates:
-            avg_gates = np.mean([gate_per_cliff[qubit][basis_gate] for qubit in qubits])
-            print("Number of %s gates per Clifford: %f"%(basis_gate, avg_gates))
+        if verbose:
+            print("Qubit(s):", qubits)
+            for basis_gate in basis_gates:
+                avg_gates = np.mean(gates_per_cliff[basis_gate][qubits])
+                print("Number of %s gates per Clifford: %f"%(basis_gate, avg_gates))
 
     return avg_gate_list
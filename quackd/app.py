@@ -1,17 +1,28 @@
 import argparse
 import html
+import os
 import re
+import sys
+import tempfile
+import urllib.request
 
 from qiskit import Aer
 from quantuminspire.qiskit import QI
 from slack_bolt import App # type:ignore
 from slack_bolt.adapter.socket_mode import SocketModeHandler # type:ignore
 
-from crypto import encrypt_text, decrypt_text, fernet_keygen, sha3_digest
+from backends import BackendPool
+from bitkey import BitKey
+from calibration import Calibrator
+from crypto import encrypt_text, decrypt_text, sha3_digest, \
+    encrypt_stream, decrypt_stream
 from globals import *
 from keychain import KeyChain
+from profiling import profiler
 from progress import SlackProgress
+from store import is_shared_store
 from utils import load_slack_tokens, set_qi_auth
+from workers import supervise
 
 
 parser = argparse.ArgumentParser()
@@ -20,9 +31,10 @@ parser.add_argument(
     help='specify path to the file containing Slack tokens'
 )
 parser.add_argument(
-    'backend',
+    'backends',
+    nargs='+',
     choices=['aer', 'qi_sim', 'qi_starmon'],
-    help='specify backend for running B92 protocol'
+    help='specify backends for running B92 protocol, in order of preference'
 )
 parser.add_argument(
     '--qi_auth_path', '-a',
@@ -32,28 +44,89 @@ parser.add_argument(
     '--keychain_path', '-k',
     help='specify path to the file containing a saved global keychain'
 )
+parser.add_argument(
+    '--calibration_dir', '-c',
+    help='specify directory in which backend calibration tables are published'
+)
+parser.add_argument(
+    '--key_ttl',
+    type=float,
+    default=KEY_TTL,
+    help='specify seconds after which distributed keys expire (no expiry by default)'
+)
+parser.add_argument(
+    '--max_keys_per_host',
+    type=int,
+    default=KEY_MAX_PER_HOST,
+    help='specify number of keys kept per local keychain before the oldest is '
+        f'evicted, or 0 for no limit (default {KEY_MAX_PER_HOST})'
+)
+parser.add_argument(
+    '--workers', '-w',
+    type=int,
+    default=1,
+    help='specify number of worker processes, which requires an SQLite keychain '
+        '(--keychain_path ending in .db or .sqlite) and --calibration_dir'
+)
+parser.add_argument(
+    '--admins',
+    nargs='*',
+    default=[],
+    help='specify IDs of users allowed to use admin commands such as /profile'
+)
+parser.add_argument(
+    '--worker_id',
+    type=int,
+    help=argparse.SUPPRESS
+)
 args = parser.parse_args()
 
+if args.workers > 1 and args.worker_id is None:
+    if not is_shared_store(args.keychain_path):
+        raise ValueError('an SQLite keychain must be specified '
+            'when running multiple workers')
+    if args.calibration_dir is None:
+        # otherwise only the first worker would ever have calibration tables
+        raise ValueError('a calibration directory must be specified '
+            'when running multiple workers')
+    sys.exit(supervise(args.workers))
+
 slack_app_token, slack_bot_token = load_slack_tokens(args.slack_tokens_path)
 app = App(token=slack_bot_token)
 
-if args.backend == 'aer':
-    backend = Aer.get_backend('aer_simulator')
-else:
+if any(b != 'aer' for b in args.backends):
     if args.qi_auth_path is None:
         raise ValueError('QI authentication file must be specified '
-            'when the Aer backend is not in use')
+            'when a backend other than Aer is in use')
     set_qi_auth(args.qi_auth_path)
-    if args.backend == 'qi_sim':
-        backend = QI.get_backend('QX single-node simulator')
-    elif args.backend == 'qi_starmon':
-        backend = QI.get_backend('Starmon-5')
+
+
+def _get_backend(name):
+    if name == 'aer':
+        return Aer.get_backend('aer_simulator')
+    elif name == 'qi_sim':
+        return QI.get_backend('QX single-node simulator')
+    elif name == 'qi_starmon':
+        return QI.get_backend('Starmon-5')
     else:
-        raise ValueError(f'unknown backend specification "{args.backend}"')
+        raise ValueError(f'unknown backend specification "{name}"')
+
+backend_pool = BackendPool({b: _get_backend(b) for b in args.backends})
+
+calibrator = Calibrator(
+    backend_pool=backend_pool,
+    n_qubits=B92_DEFAULT_KWARGS['n'],
+    calibration_dir=args.calibration_dir,
+    # only the first worker calibrates; the others follow its published tables
+    publish=args.worker_id in (None, 0)
+)
 
 kc_global = KeyChain(
-    backend=backend,
+    backend_pool=backend_pool,
+    calibrator=calibrator,
     keychain_path=args.keychain_path,
+    key_ttl=args.key_ttl,
+    max_keys_per_host=args.max_keys_per_host or None,
     **B92_DEFAULT_KWARGS
 )
 
@@ -90,6 +163,7 @@ def _parse_command(command):
 
 
 @app.command('/qkd')
+@profiler.wrap('qkd')
 def qkd(ack, respond, command):
     ack()
 
@@ -102,7 +176,7 @@ def qkd(ack, respond, command):
         return
 
     h_key = sha3_digest(key_orig)
-    key = bin(int(h_key, 16))[2:][:KEY_INIT_SIZE]
+    key = BitKey(bin(int(h_key, 16))[2:][:KEY_INIT_SIZE])
 
     respond(f'Sharing key `{key_orig}` to {dst_tag} as `{key}` ({KEY_INIT_SIZE} bits).')
 
@@ -119,11 +193,13 @@ def qkd(ack, respond, command):
     pbar = sp.new(total=N_PBAR_ITEMS)
     pbar.pos = 0
 
-    sent_key, recv_key = kc_global.add(src_id, members, src_id, dst_id, key, pbar)
+    sent_key, recv_key, backend = kc_global.add(
+        src_id, members, src_id, dst_id, key, pbar
+    )
 
     if len(sent_key) >= KEY_MIN_SIZE:
         respond(f'Stored key `{sent_key}` '
-            f'({len(sent_key)} bits) after reconciliation.')
+            f'({len(sent_key)} bits) after reconciliation on `{backend}`.')
     else:
         respond(f'Shared key `{sent_key}` is discarded '
             f'(minimum length of {KEY_MIN_SIZE} required).')
@@ -145,25 +221,32 @@ def qkd(ack, respond, command):
 
 
 @app.command('/kc')
+@profiler.wrap('kc')
 def kc(ack, respond, command):
     ack()
 
     host_id = command['user_id']
     host_tag = _tag(TYPE_USER, host_id)
 
-    if command['text'] != '':
-        respond(f'Usage: /kc')
+    page_text = command['text'].strip()
+    if page_text != '' and not (page_text.isdigit() and int(page_text) >= 1):
+        respond(f'Usage: /kc [page]')
         return
+    page = int(page_text) if page_text else 1
 
-    kc_local = kc_global.get_keychain(host_id)
+    offset = (page - 1) * KC_PAGE_SIZE
+    kc_local, n_keys = kc_global.get_keychain(host_id, offset, KC_PAGE_SIZE)
+    n_pages = max((n_keys + KC_PAGE_SIZE - 1) // KC_PAGE_SIZE, 1)
     if kc_local is None:
         respond(f'{host_tag}\'s local keychain hasn\'t been created!')
-    elif len(kc_local) == 0:
+    elif n_keys == 0:
         respond(f'{host_tag}\'s local keychain is empty!')
+    elif len(kc_local) == 0:
+        respond(f'{host_tag}\'s local keychain only has {n_pages} page(s).')
     else:
-        resp = f'{host_tag}\'s local keychain:'
-        resp_idx = 0
-        for (src_id, dst_id), (key, ts) in kc_local.items():
+        resp = f'{host_tag}\'s local keychain (page {page}/{n_pages}):'
+        resp_idx = offset
+        for (src_id, dst_id), (key, ts, backend, digest, calibration) in kc_local:
             src_tag = _tag(TYPE_USER, src_id)
             if dst_id[0] == PREFIX_CHANNEL:
                 dst_tag = _tag(TYPE_CHANNEL, dst_id)
@@ -171,11 +254,13 @@ def kc(ack, respond, command):
                 dst_tag = _tag(TYPE_USER, dst_id)
             else:
                 raise ValueError(f'ID "{dst_id}" contains an invalid prefix')
-            is_equal, h_val, _ = kc_global.validate(sha3_digest(key), src_id, dst_id)
+            is_equal, h_val, _ = kc_global.validate(digest, src_id, dst_id)
             repr_equal = '✅' if is_equal else '❌'
             resp_idx += 1
             resp += f'\n└ {resp_idx}. {src_tag} ➡️ {dst_tag} : '\
-                f'🔑 `{key}` {repr_equal} {h_val} ⏱️ {ts}'
+                f'🔑 `{key}` {repr_equal} {h_val} ⏱️ {ts} 🖥️ {backend}'
+            if calibration is not None:
+                resp += f' 🎛️ v{calibration}'
         respond(resp)
 
 
@@ -196,7 +281,8 @@ def _parse_event(event):
     if res is not None:
         i_start, i_end = res.span()
         text_trunc = text_orig[i_end:]
-        if i_start == 0 and text_trunc and not str.isspace(text_trunc):
+        has_text = text_trunc and not str.isspace(text_trunc)
+        if i_start == 0 and (has_text or event.get('files')):
             dst_type = res.groups()[0]
             dst_id = res.groups()[1]
             dst_tag = _tag(dst_type, dst_id)
@@ -207,10 +293,36 @@ def _parse_event(event):
         text
 
 
+def _open_dm(user_id):
+    return app.client.conversations_open(users=user_id)['channel']['id']
+
+
+def _encrypt_file(file, cipher, dir):
+    # encrypt the download as it streams in, so that plaintext never hits disk
+    cipher_path = os.path.join(dir, f'{file["id"]}.qkd')
+    req = urllib.request.Request(
+        file['url_private_download'],
+        headers={'Authorization': f'Bearer {slack_bot_token}'}
+    )
+    with urllib.request.urlopen(req) as src, open(cipher_path, 'wb') as dst:
+        encrypt_stream(src, dst, cipher)
+    return cipher_path
+
+
+def _decrypt_file(cipher_path, cipher, dir, tag):
+    plain_path = os.path.join(dir, f'{os.path.basename(cipher_path)}.{tag}')
+    with open(cipher_path, 'rb') as src, open(plain_path, 'wb') as dst:
+        decrypt_stream(src, dst, cipher)
+    return plain_path
+
+
 @app.event('message')
+@profiler.wrap('message')
 def message(body, logger):
     if body['event'].get('subtype') == 'message_changed':
         return
+    if body['event'].get('user') == bot_id:
+        return
 
     (src_id, src_tag), \
         (dst_type, dst_id, dst_tag), \
@@ -220,7 +332,7 @@ def message(body, logger):
         app.client.chat_postEphemeral(
             channel=src_id,
             user=src_id,
-            text=f'Usage: @user/#channel message'
+            text=f'Usage: @user/#channel message (with optional file attachments)'
         )
         return
 
@@ -235,9 +347,9 @@ def message(body, logger):
         raise NotImplementedError(f'Unknown destination type "{dst_type}"')
 
     plain_text = text.strip() # type: ignore
-    key, _ = kc_global.query(src_id, src_id, dst_id)
+    [(entry, ciphers)] = kc_global.lookup([src_id], src_id, dst_id)
 
-    if key is None:
+    if entry.key is None:
         app.client.chat_postEphemeral(
             channel=src_id,
             user=src_id,
@@ -246,40 +358,108 @@ def message(body, logger):
         )
         return
 
-    cipher_text = encrypt_text(plain_text, fernet_keygen(key))
-    app.client.chat_postMessage(
-        channel=channel_id,
-        text=f'{src_tag} ➡️ {dst_tag} :\n```{cipher_text}```'
-    )
+    files = body['event'].get('files', [])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if plain_text:
+            cipher_text = encrypt_text(plain_text, ciphers.fernet)
+            app.client.chat_postMessage(
+                channel=channel_id,
+                text=f'{src_tag} ➡️ {dst_tag} :\n```{cipher_text}```'
+            )
 
-    if dst_type == TYPE_CHANNEL:
-        members = app.client.conversations_members(channel=dst_id)['members']
-        if src_id in members:
-            members.remove(src_id)
-    elif dst_type == TYPE_USER:
-        members = [dst_id]
-    else:
-        raise NotImplementedError(f'Unknown destination type "{dst_type}"')
+        if files:
+            cipher_paths = [_encrypt_file(f, ciphers.stream, tmp_dir) for f in files]
+            for f, path in zip(files, cipher_paths):
+                app.client.files_upload_v2(
+                    channel=channel_id,
+                    file=path,
+                    filename=f'{f["name"]}.qkd',
+                    initial_comment=f'{src_tag} ➡️ {dst_tag} : encrypted `{f["name"]}`'
+                )
+
+        if dst_type == TYPE_CHANNEL:
+            members = app.client.conversations_members(channel=dst_id)['members']
+            if src_id in members:
+                members.remove(src_id)
+        elif dst_type == TYPE_USER:
+            members = [dst_id]
+        else:
+            raise NotImplementedError(f'Unknown destination type "{dst_type}"')
+
+        # members of a group share one key entry and its ciphers, so each message
+        # and file is decrypted once per distinct entry rather than once per member
+        plain_texts = {}
+        plain_paths = {}
+        for m, (m_entry, m_ciphers) in zip(
+            members, kc_global.lookup(members, src_id, dst_id)
+        ):
+            if m_entry.key is None:
+                app.client.chat_postEphemeral(
+                    channel=m,
+                    user=m,
+                    text=f'Unable to decode message for {src_tag} ➡️ {dst_tag} '
+                        '(key not present on local keychain). '
+                        f'Please contact {src_tag} to obtain a key via QKD.'
+                )
+                return
+
+            if plain_text:
+                if m_entry.digest not in plain_texts:
+                    plain_texts[m_entry.digest] = decrypt_text(
+                        cipher_text, m_ciphers.fernet
+                    )
+                app.client.chat_postMessage(
+                    channel=m,
+                    text=f'{src_tag} ➡️ {dst_tag} : {plain_texts[m_entry.digest]}'
+                )
+
+            if files:
+                if m_entry.digest not in plain_paths:
+                    plain_paths[m_entry.digest] = [
+                        _decrypt_file(path, m_ciphers.stream, tmp_dir, m_entry.digest[:16])
+                        for path in cipher_paths
+                    ]
+                m_channel = _open_dm(m)
+                for f, plain_path in zip(files, plain_paths[m_entry.digest]):
+                    app.client.files_upload_v2(
+                        channel=m_channel,
+                        file=plain_path,
+                        filename=f['name'],
+                        initial_comment=f'{src_tag} ➡️ {dst_tag} : decrypted `{f["name"]}`'
+                    )
+
+
+@app.command('/profile')
+def profile(ack, respond, command):
+    ack()
 
-    for m in members:
-        m_key, _ = kc_global.query(m, src_id, dst_id)
+    if command['user_id'] not in args.admins:
+        respond(f'/profile is restricted to admins.')
+        return
 
-        if m_key is None:
-            app.client.chat_postEphemeral(
-                channel=m,
-                user=m,
-                text=f'Unable to decode message for {src_tag} ➡️ {dst_tag} '
-                    '(key not present on local keychain). '
-                    f'Please contact {src_tag} to obtain a key via QKD.'
-            )
+    usage = f'Usage: /profile [target [n] | off]\n' \
+        f'Targets: {", ".join(sorted(profiler.targets))}'
+    argv = command['text'].split()
+
+    if len(argv) == 0:
+        respond(usage)
+    elif argv == ['off']:
+        profiler.disable()
+        respond('Profiling disabled.')
+    elif len(argv) <= 2 and (len(argv) == 1 or argv[1].isdigit()):
+        n = int(argv[1]) if len(argv) == 2 else PROFILE_DEFAULT_N
+        matched = profiler.enable(argv[0], n)
+        if not matched:
+            respond(usage)
             return
-
-        decrypted_text = decrypt_text(cipher_text, fernet_keygen(m_key))
-        app.client.chat_postMessage(
-            channel=m,
-            text=f'{src_tag} ➡️ {dst_tag} : {decrypted_text}'
-        )
+        respond(f'Profiling the next {n} invocations of {", ".join(sorted(matched))} '
+            f'to `{os.path.abspath(profiler.profile_dir)}`.')
+    else:
+        respond(usage)
 
 
 if __name__ == '__main__':
+    profiler.enable_from_spec(os.environ.get('QUACKD_PROFILE', ''))
+    kc_global.start_sweeper()
+    calibrator.start()
     SocketModeHandler(app, slack_app_token).start()
@@ -7,7 +7,10 @@ import numpy as np
 from qiskit import Aer, execute, QuantumRegister, QuantumCircuit
 from qiskit.ignis.mitigation.measurement import complete_meas_cal, CompleteMeasFitter
 
+from backends import BackendError
+from bitkey import BitKey
 from globals import *
+from profiling import profiler
 
 
 class B92:
@@ -19,35 +22,58 @@ class B92:
         meas_err_mitig=False,
         n_shots=1024,
         backend=Aer.get_backend('aer_simulator'),
+        calibration=None,
+        threshold=B92_THRESHOLD,
+        num_cascade_iters=B92_CASCADE_ITERS,
+        job_timeout=BACKEND_JOB_TIMEOUT,
         **execute_kwargs
     ):
+        """
+        calibration [CalibrationTable]: latest published calibration of the backend;
+                                        readout is calibrated per run if not given
+        threshold [float]: fraction of shots with eigenvalue -1 above which a bit
+                           is determined
+        num_cascade_iters [int]: number of cascade passes
+        job_timeout [float]: seconds to wait for the results of a job, or None
+        """
         self.pbar = pbar
         self._log_pbar('Started QKD protocol')
 
         # circuit
-        self.alice_string = alice_string
+        self.alice_string = BitKey(alice_string)
+        self.alice_bits = self.alice_string.to_array()
         self.n = n
         self.bob_bases = np.random.choice(['X', 'Z'], len(self.alice_string))
         self.meas_err_mitig = meas_err_mitig
         self.n_shots = n_shots
         self.backend = backend
+        self.threshold = threshold
+        self.num_cascade_iters = num_cascade_iters
+        self.job_timeout = job_timeout
         self.execute_kwargs = execute_kwargs
 
-        self.meas_fitters = [
-            self.create_calibration_matrix(self.n, [i]) for i in range(self.n)
-        ]
+        self.calibration = calibration
+        if not self.meas_err_mitig:
+            self.meas_filters = []
+        elif self.calibration is not None:
+            self.meas_filters = self.calibration.meas_filters[: self.n]
+        else:
+            self.meas_filters = [
+                self.create_calibration_matrix(self.n, [i]).filter
+                for i in range(self.n)
+            ]
 
-        self.basis_to_bit = {'Z': '1', 'X': '0'}
+        self.basis_to_bit = {'Z': 1, 'X': 0}
 
-        self.inter_bit_string = ''
-        self.known_indices = []
+        self.inter_bits = np.zeros(len(self.alice_string), dtype=np.uint8)
+        self.known_indices = np.zeros(0, dtype=int)
 
         # cascade
         self.N = -1
         self.Q = -1
 
-        self.sent_digits = []
-        self.corrected_digits = []
+        self.sent_digits = np.zeros(0, dtype=np.uint8)
+        self.corrected_digits = np.zeros(0, dtype=np.uint8)
 
         self.parity_checks = [0]
         self.block_sizes = []
@@ -58,6 +84,22 @@ class B92:
         self.pbar.pos += 1
         self.pbar.log(msg)
 
+    def _submit(self, circuits, **execute_kwargs):
+        try:
+            return execute(
+                circuits, backend=self.backend, shots=self.n_shots, **execute_kwargs
+            )
+        except Exception as e:
+            raise BackendError(f'failed to submit job: {e}') from e
+
+    def _get_result(self, job):
+        # a stalled backend fails like an unreachable one, so that jobs fail over
+        try:
+            return job.result(timeout=self.job_timeout)
+        except Exception as e:
+            raise BackendError(f'failed to get job result: {e}') from e
+
+    @profiler.wrap('b92.calibration')
     def create_calibration_matrix(self, qubits, qubit_list):
         """
         qubits [int]: number of qubits
@@ -69,23 +111,21 @@ class B92:
             qubit_list=qubit_list, qr=qr, circlabel='cal'  # type: ignore
         )
         # create calibration matrix by running calibration
-        job = execute(
-            meas_calibs, backend=self.backend, shots=self.n_shots, **self.execute_kwargs
-        )
-        cal_results = job.result()  # type: ignore
+        job = self._submit(meas_calibs, **self.execute_kwargs)
+        cal_results = self._get_result(job)
         meas_fitter = CompleteMeasFitter(cal_results, state_labels, circlabel='cal')
         return meas_fitter
 
-    def apply_measurement_error_mitigation(self, meas_fitter, raw_counts):
+    def apply_measurement_error_mitigation(self, meas_filter, raw_counts):
         """
-        meas_fitter [qiskit ignis CompleteMeasFitter object]: calibration matrix fitter
+        meas_filter [qiskit ignis MeasurementFilter object]: calibration matrix filter
         raw_counts [dict]: dictionary of bitstrings with respective counts
         """
         # apply measurement error mitigation via calibration matrix
-        meas_filter = meas_fitter.filter
         mitigated_results = meas_filter.apply(raw_counts)
         return mitigated_results
 
+    @profiler.wrap('b92.circuit')
     def build_circuit_n(self):
         if len(self.alice_string) != len(self.bob_bases):
             raise IndexError(
@@ -103,16 +143,16 @@ class B92:
 
             qr = QuantumRegister(reg_len)
             circuit = QuantumCircuit(qr)
-            bits = self.alice_string[index : index + reg_len]
+            bits = self.alice_bits[index : index + reg_len]
             bases = self.bob_bases[index : index + reg_len]
 
             # Step 1: Initialize qubits according to Alice's bit string
             for r in range(reg_len):
                 bit = bits[r]
 
-                if bit == '0':  # if the bit is 0
+                if bit == 0:  # if the bit is 0
                     circuit.i(qr[r])  # we initialize the qubit in the |0> state
-                elif bit == '1':  # if the bit is 1
+                elif bit == 1:  # if the bit is 1
                     circuit.h(qr[r])  # we initialize the qubit in the |+> state
 
             # Step 2: Measure qubits in Bob's chosen bases
@@ -130,19 +170,19 @@ class B92:
 
         self._log_pbar('Synthesized B92 circuits')
         # Step 3: run the circuits on the Quantum Inspire backend and compile the results
-        qi_job = execute(circuits, backend=self.backend, shots=self.n_shots)
+        qi_job = self._submit(circuits)
         self._log_pbar('Submitted jobs to backend')
-        qi_result = qi_job.result()  # type: ignore
+        qi_result = self._get_result(qi_job)
         self._log_pbar('Acquired measurement results')
 
         # Step 4: collect bits based on measurement results
+        ones = np.zeros(length)
         for index in range(0, length, self.n):
             reg_len = self.n
             if length - index < self.n:
                 reg_len = length - index
 
             bases = self.bob_bases[index : index + reg_len]
-            bits = self.alice_string[index : index + reg_len]
             circuit = circuits[index // self.n]
             histogram = qi_result.get_counts(circuit)
 
@@ -155,7 +195,7 @@ class B92:
 
                 if self.meas_err_mitig:
                     eigvl_cnts = self.apply_measurement_error_mitigation(
-                        self.meas_fitters[r], eigvl_cnts
+                        self.meas_filters[r], eigvl_cnts
                     )
 
                 if '0' not in eigvl_cnts:
@@ -163,44 +203,43 @@ class B92:
                 if '1' not in eigvl_cnts:
                     eigvl_cnts['1'] = 0  # type: ignore
 
-                if eigvl_cnts['1'] >= 0.3 * self.n_shots:  # type: ignore
-                    basis = bases[r]
-                    bit = self.basis_to_bit[basis.upper()]
-                    # this index with eigvl = -1 gives a determined bit that we append to known_indices
-                    self.known_indices.append(index + r)
-                else:
-                    bit = 'n'  # bit is indeterminate
+                ones[index + r] = eigvl_cnts['1']  # type: ignore
 
-                self.inter_bit_string += bit
+        self.sift(ones)
+
+    def sift(self, ones):
+        """
+        ones [np.ndarray]: per-bit number of shots measured with eigenvalue -1
+        """
+        # indices with eigvl = -1 in enough shots give determined bits
+        self.known_indices = np.flatnonzero(ones >= self.threshold * self.n_shots)
+        # otherwise the bit is indeterminate and gets sifted out
+        bases = np.char.upper(self.bob_bases[self.known_indices])
+        self.inter_bits[self.known_indices] = np.where(
+            bases == 'Z', self.basis_to_bit['Z'], self.basis_to_bit['X']
+        )
 
         self._log_pbar('Sifted keys from matching bases')
         # initialize for cascade
-        self.sent_digits = [self.alice_string[index] for index in self.known_indices]
-        self.corrected_digits = [
-            self.inter_bit_string[index] for index in self.known_indices
-        ]
+        self.sent_digits = self.alice_bits[self.known_indices]
+        self.corrected_digits = self.inter_bits[self.known_indices]
         self.N = len(self.known_indices)
-        self.Q = np.mean(np.array(self.sent_digits) != np.array(self.corrected_digits))
+        # nothing to reconcile if every bit was sifted out
+        self.Q = np.mean(self.sent_digits != self.corrected_digits) if self.N else 0.0
 
     # count parity
     def parity(self, block):
-        return block.count('1') % 2
+        return int(block.sum()) % 2
 
     # binary split and correct odd parities
     def bin_split(self, si, fi, parity_cnt=1):
-        if fi < self.N:
-            block_a = self.sent_digits[si:fi]
-            block_b = self.corrected_digits[si:fi]
-        else:
-            block_a = self.sent_digits[si : self.N - 1] + [self.sent_digits[self.N - 1]]
-            block_b = self.corrected_digits[si : self.N - 1] + [
-                self.corrected_digits[self.N - 1]
-            ]
+        block_a = self.sent_digits[si : min(fi, self.N)]
+        block_b = self.corrected_digits[si : min(fi, self.N)]
 
         if self.parity(block_a) != self.parity(block_b):
             if fi - si == 1:
-                # '0' -> '1' and '1' -> '0'
-                self.corrected_digits[si] = str(1 - int(self.corrected_digits[si]))
+                # 0 -> 1 and 1 -> 0
+                self.corrected_digits[si] ^= 1
                 return parity_cnt
             else:
                 # right block bigger
@@ -220,14 +259,11 @@ class B92:
 
     def shuffle(self, iter_n, block):
         perm = self.getperm(iter_n, block)
-        block[:] = [block[j] for j in perm]
+        block[:] = block[perm]
 
     def unshuffle(self, iter_n, block):
         perm = self.getperm(iter_n, block)
-        res = [None] * len(block)
-        for i, j in enumerate(perm):
-            res[j] = block[i]
-        block[:] = res
+        block[perm] = block.copy()
 
     # shuffle, binary split blocks, unshuffle
     def cascade(self, iter_n):
@@ -235,7 +271,8 @@ class B92:
         if self.Q == 0.0:
             k = self.N
         else:
-            k = min(int(0.73 / self.Q * 2 ** iter_n), self.N)
+            # error rates above 0.73 would give empty blocks
+            k = max(min(int(0.73 / self.Q * 2 ** iter_n), self.N), 1)
         self.block_sizes.append(k)
 
         self.shuffle(iter_n, self.sent_digits)
@@ -254,22 +291,25 @@ class B92:
         self.unshuffle(iter_n, self.sent_digits)
         self.unshuffle(iter_n, self.corrected_digits)
 
-    def correct_bobs_digits(self, num_cascade_iters=5):
+    @profiler.wrap('b92.cascade')
+    def correct_bobs_digits(self, num_cascade_iters=None):
+        if num_cascade_iters is None:
+            num_cascade_iters = self.num_cascade_iters
         self.errors = [self.Q]
+        if self.N == 0:
+            num_cascade_iters = 0
         for c in range(num_cascade_iters):
             self.cascade(c)
-            error = np.mean(
-                np.array(self.sent_digits) != np.array(self.corrected_digits)
-            )
+            error = np.mean(self.sent_digits != self.corrected_digits)
             self.errors.append(error)
         self._log_pbar('Completed cascade information reconciliation')
 
     def generate_corrected_key(self):
         self.build_circuit_n()
         self.correct_bobs_digits()
-        return ''.join(self.corrected_digits)
+        return BitKey.from_array(self.corrected_digits)
 
     def get_key_pair(self):
         corrected_digits = self.generate_corrected_key()
         self._log_pbar('Finished QKD protocol')
-        return ''.join(self.sent_digits), corrected_digits
+        return BitKey.from_array(self.sent_digits), corrected_digits
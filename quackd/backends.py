@@ -0,0 +1,135 @@
+import threading
+import time
+
+from globals import *
+
+
+class BackendError(Exception):
+    """
+    Raised for jobs that a backend fails to accept or to finish in time, as
+    opposed to errors in processing their results
+    """
+
+
+class BackendState:
+    def __init__(self, name, backend, rank):
+        self.name = name
+        self.backend = backend
+        self.rank = rank
+
+        # EWMA of observed wall time per QKD job, in seconds
+        self.latency = None
+        self.n_jobs = 0
+        # jobs submitted through the pool that haven't finished yet
+        self.in_flight = 0
+
+        # circuit breaker
+        self.failures = 0
+        self.opened_at = None
+
+
+class BackendPool:
+    def __init__(
+        self,
+        backends,
+        max_failures=BACKEND_MAX_FAILURES,
+        cooldown=BACKEND_COOLDOWN,
+        ewma_alpha=BACKEND_EWMA_ALPHA
+    ):
+        """
+        backends [dict]: mapping of backend names to backends, in order of preference
+        max_failures [int]: consecutive failures before the breaker of a backend opens
+        cooldown [float]: seconds an open breaker waits before allowing a trial job
+        ewma_alpha [float]: smoothing factor of the observed job latency
+        """
+        if len(backends) == 0:
+            raise ValueError('backend pool requires at least one backend')
+        self.states = {
+            name: BackendState(name, backend, rank)
+            for rank, (name, backend) in enumerate(backends.items())
+        }
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+
+
+    def _is_closed(self, state, now):
+        # a breaker past its cooldown is half-open and admits a trial job
+        return state.opened_at is None or now - state.opened_at >= self.cooldown
+
+
+    def _queue_time(self, state):
+        latency = state.latency
+        try:
+            pending_jobs = state.backend.status().pending_jobs
+        except Exception:
+            pending_jobs = 0
+        # jobs still running count too, so a stalled backend stops attracting jobs
+        # before any of them completes
+        return latency * (1 + state.in_flight + pending_jobs)
+
+
+    def candidates(self):
+        with self._lock:
+            now = time.monotonic()
+            states = list(self.states.values())
+            closed = [s for s in states if self._is_closed(s, now)]
+        if closed:
+            # backends without a latency sample follow measured ones, by rank,
+            # rather than being treated as free
+            measured = [s for s in closed if s.latency is not None]
+            unmeasured = [s for s in closed if s.latency is None]
+            return sorted(measured, key=lambda s: (self._queue_time(s), s.rank)) \
+                + sorted(unmeasured, key=lambda s: s.rank)
+        # every breaker is open; probe the one that has been open the longest
+        return sorted(states, key=lambda s: s.opened_at)
+
+
+    def record_success(self, name, elapsed):
+        with self._lock:
+            state = self.states[name]
+            state.failures = 0
+            state.opened_at = None
+            state.n_jobs += 1
+            if state.latency is None:
+                state.latency = elapsed
+            else:
+                state.latency += self.ewma_alpha * (elapsed - state.latency)
+
+
+    def record_failure(self, name):
+        with self._lock:
+            state = self.states[name]
+            state.failures += 1
+            if state.failures >= self.max_failures:
+                state.opened_at = time.monotonic()
+
+
+    def run(self, fn, on_failure=None):
+        """
+        Run fn(name, backend) on the best available backend, failing over in order of
+        observed queue time. Returns the name of the backend used and the result.
+        Only BackendError counts against a backend and fails over; other errors
+        are raised as is.
+        """
+        last_exc = None
+        for state in self.candidates():
+            t_start = time.monotonic()
+            with self._lock:
+                state.in_flight += 1
+            try:
+                res = fn(state.name, state.backend)
+            except BackendError as e:
+                self.record_failure(state.name)
+                if on_failure is not None:
+                    on_failure(state.name, e)
+                last_exc = e
+                continue
+            finally:
+                with self._lock:
+                    state.in_flight -= 1
+            self.record_success(state.name, time.monotonic() - t_start)
+            return state.name, res
+        raise RuntimeError('all backends in the pool failed') from last_exc
+
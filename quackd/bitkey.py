@@ -0,0 +1,95 @@
+import numpy as np
+
+
+class BitKey:
+    """
+    Immutable bit string packed into a Python int. Bit 0 is the most significant
+    bit, so str(BitKey('0110')) == '0110' and slicing follows string semantics.
+    """
+    __slots__ = ('_value', '_len')
+
+    def __init__(self, bits=''):
+        """
+        bits [str/BitKey]: string of '0'/'1' characters, or another BitKey
+        """
+        if isinstance(bits, BitKey):
+            self._value, self._len = bits._value, bits._len
+            return
+        if bits.strip('01'):
+            raise ValueError(f'invalid bit string "{bits}"')
+        self._value = int(bits, 2) if bits else 0
+        self._len = len(bits)
+
+    @classmethod
+    def from_int(cls, value, n):
+        key = cls.__new__(cls)
+        key._value = value & ((1 << n) - 1)
+        key._len = n
+        return key
+
+    @classmethod
+    def from_bytes(cls, data, n):
+        """
+        data [bytes]: bits packed MSB first, zero-padded at the end of the last byte
+        n [int]: number of bits
+        """
+        return cls.from_int(int.from_bytes(data, 'big') >> (8 * len(data) - n), n)
+
+    @classmethod
+    def from_array(cls, arr):
+        """
+        arr [np.ndarray]: array of 0/1 values
+        """
+        arr = np.asarray(arr, dtype=np.uint8)
+        return cls.from_bytes(np.packbits(arr).tobytes(), len(arr))
+
+    def to_bytes(self):
+        n_bytes = (self._len + 7) // 8
+        return (self._value << (8 * n_bytes - self._len)).to_bytes(n_bytes, 'big')
+
+    def to_array(self):
+        arr = np.unpackbits(np.frombuffer(self.to_bytes(), dtype=np.uint8))
+        return arr[: self._len]
+
+    def count(self):
+        return bin(self._value).count('1')
+
+    def __int__(self):
+        return self._value
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self._len)
+            if step != 1:
+                return BitKey(str(self)[idx])
+            n = max(stop - start, 0)
+            return BitKey.from_int(self._value >> (self._len - start - n), n)
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError('bit index out of range')
+        return (self._value >> (self._len - 1 - idx)) & 1
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield (self._value >> (self._len - 1 - i)) & 1
+
+    def __eq__(self, other):
+        if not isinstance(other, BitKey):
+            return NotImplemented
+        return self._len == other._len and self._value == other._value
+
+    def __hash__(self):
+        return hash((self._len, self._value))
+
+    def __str__(self):
+        return format(self._value, f'0{self._len}b') if self._len else ''
+
+    def __repr__(self):
+        return f'BitKey(\'{self}\')'
+
+    def __format__(self, spec):
+        return format(str(self), spec)
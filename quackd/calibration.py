@@ -0,0 +1,238 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import glob
+import os
+import threading
+
+import numpy as np
+from qiskit import execute, QuantumRegister
+from qiskit.ignis.mitigation.measurement import complete_meas_cal, \
+    CompleteMeasFitter, MeasurementFilter
+import qiskit.ignis.verification.randomized_benchmarking as rb
+
+from globals import *
+from utils import timestamp
+
+
+CalibrationTable = namedtuple(
+    'CalibrationTable',
+    ['version', 'backend', 'ts', 'cal_matrices', 'readout_error', 'epc', 'meas_filters']
+)
+
+
+def _make_table(version, backend, ts, cal_matrices, epc):
+    cal_matrices = np.asarray(cal_matrices, dtype=float)
+    # probability of reading out the wrong state, averaged over prepared states
+    readout_error = 1 - np.mean(np.diagonal(cal_matrices, axis1=1, axis2=2), axis=1)
+    meas_filters = [MeasurementFilter(m, ['0', '1']) for m in cal_matrices]
+    return CalibrationTable(
+        version, backend, ts, cal_matrices, readout_error,
+        np.asarray(epc, dtype=float), meas_filters
+    )
+
+
+def readout_calibration(backend, n_qubits, n_shots, **execute_kwargs):
+    """
+    Returns per-qubit readout calibration matrices of shape (n_qubits, 2, 2),
+    running the calibration circuits of all qubits as a single job
+    """
+    qr = QuantumRegister(n_qubits)
+    circuits = []
+    state_labels = None
+    for q in range(n_qubits):
+        meas_calibs, state_labels = complete_meas_cal(
+            qubit_list=[q], qr=qr, circlabel=f'cal{q}'  # type: ignore
+        )
+        circuits += meas_calibs
+    job = execute(circuits, backend=backend, shots=n_shots, **execute_kwargs)
+    cal_results = job.result()  # type: ignore
+    return np.array([
+        CompleteMeasFitter(cal_results, state_labels, circlabel=f'cal{q}').cal_matrix
+        for q in range(n_qubits)
+    ])
+
+
+def rb_calibration(backend, n_qubits, n_seeds, lengths, n_shots, **execute_kwargs):
+    """
+    Returns the per-qubit error per Clifford from simultaneous single-qubit RB,
+    or NaN for qubits whose decay could not be fitted
+    """
+    pattern = [[q] for q in range(n_qubits)]
+    rb_circs, xdata = rb.randomized_benchmarking_seq(
+        nseeds=n_seeds, length_vector=lengths, rb_pattern=pattern
+    )
+    circuits = [circ for rb_circ_seed in rb_circs for circ in rb_circ_seed]
+    job = execute(circuits, backend=backend, shots=n_shots, **execute_kwargs)
+    try:
+        rbfit = rb.fitters.RBFitter(job.result(), xdata, pattern)  # type: ignore
+        return np.array([f['epc'] for f in rbfit.fit], dtype=float)
+    except Exception:
+        return np.full(n_qubits, np.nan)
+
+
+class Calibrator:
+    def __init__(
+        self,
+        backend_pool,
+        n_qubits,
+        calibration_dir=None,
+        interval=CAL_INTERVAL,
+        n_shots=CAL_N_SHOTS,
+        rb_seeds=CAL_RB_SEEDS,
+        rb_lengths=CAL_RB_LENGTHS,
+        publish=True,
+        **execute_kwargs
+    ):
+        """
+        n_qubits [int]: number of qubits to calibrate on every backend
+        calibration_dir [str]: directory in which calibration tables are published
+        publish [bool]: whether this process calibrates; otherwise the latest tables
+                        published to calibration_dir by another process are used
+        interval [float]: seconds between calibration rounds
+        rb_seeds [int]: number of RB seeds per round, or 0 to skip RB
+        """
+        self.backend_pool = backend_pool
+        self.n_qubits = n_qubits
+        self.calibration_dir = calibration_dir
+        self.interval = interval
+        self.n_shots = n_shots
+        self.rb_seeds = rb_seeds
+        self.rb_lengths = rb_lengths
+        self.publish = publish
+        self.execute_kwargs = execute_kwargs
+
+        self.tables = {}
+        self._table_paths = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+        # QKD jobs in flight; calibration rounds wait for the backends to go idle
+        self._n_busy = 0
+        self._idle = threading.Condition()
+
+        self._thread = None
+        self._stop = threading.Event()
+
+        if self.calibration_dir is not None:
+            os.makedirs(self.calibration_dir, exist_ok=True)
+            self._load_tables()
+
+
+    def _table_path(self, name, version):
+        return os.path.join(self.calibration_dir, f'{name}-{version:06d}.npz')
+
+
+    def _save_table(self, table):
+        if self.calibration_dir is None:
+            return
+        path = self._table_path(table.backend, table.version)
+        # publish atomically, as other workers may be reading the directory
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(
+                f,
+                version=table.version,
+                ts=table.ts.timestamp(),
+                cal_matrices=table.cal_matrices,
+                readout_error=table.readout_error,
+                epc=table.epc
+            )
+        os.replace(f'{path}.tmp', path)
+
+
+    def _load_tables(self):
+        for name in self.backend_pool.states:
+            paths = sorted(glob.glob(os.path.join(self.calibration_dir, f'{name}-*.npz')))
+            if not paths or paths[-1] == self._table_paths.get(name):
+                continue
+            self._table_paths[name] = paths[-1]
+            with np.load(paths[-1]) as data:
+                version = int(data['version'])
+                self.tables[name] = _make_table(
+                    version, name,
+                    datetime.fromtimestamp(float(data['ts']), timezone.utc),
+                    data['cal_matrices'], data['epc']
+                )
+            self._version = max(self._version, version)
+
+
+    def get_table(self, name):
+        if not self.publish and self.calibration_dir is not None:
+            self._load_tables()
+        with self._lock:
+            table = self.tables.get(name)
+        if table is None or len(table.meas_filters) < self.n_qubits:
+            return None
+        return table
+
+
+    def calibrate(self, name, backend):
+        cal_matrices = readout_calibration(
+            backend, self.n_qubits, self.n_shots, **self.execute_kwargs
+        )
+        if self.rb_seeds > 0:
+            epc = rb_calibration(
+                backend, self.n_qubits, self.rb_seeds, self.rb_lengths,
+                self.n_shots, **self.execute_kwargs
+            )
+        else:
+            epc = np.full(self.n_qubits, np.nan)
+        with self._lock:
+            self._version += 1
+            table = _make_table(self._version, name, timestamp(), cal_matrices, epc)
+            self.tables[name] = table
+        self._save_table(table)
+        return table
+
+
+    @contextmanager
+    def hold(self):
+        """
+        Marks a QKD job as in flight for the duration of the block
+        """
+        with self._idle:
+            self._n_busy += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._n_busy -= 1
+                self._idle.notify_all()
+
+
+    def _wait_idle(self):
+        with self._idle:
+            while self._n_busy > 0 and not self._stop.is_set():
+                self._idle.wait(timeout=1.0)
+
+
+    def run_round(self):
+        for state in self.backend_pool.candidates():
+            self._wait_idle()
+            if self._stop.is_set():
+                return
+            try:
+                self.calibrate(state.name, state.backend)
+            except Exception:
+                self.backend_pool.record_failure(state.name)
+
+
+    def start(self):
+        if not self.publish:
+            return
+
+        def run():
+            while not self._stop.is_set():
+                self.run_round()
+                self._stop.wait(self.interval)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
@@ -1,23 +1,47 @@
 import base64
+from collections import namedtuple
+import os
+import struct
+
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import hashlib
 
+from globals import *
+
+
+STREAM_MAGIC = b'QKDS'
+STREAM_NONCE_PREFIX_SIZE = 8
+STREAM_TAG_SIZE = 16
+# bit 31 of a chunk header marks the final chunk of the stream
+STREAM_FINAL_FLAG = 1 << 31
 
-def fernet_keygen(key):
+KeyCiphers = namedtuple('KeyCiphers', ['fernet', 'stream'])
+
+
+def _derive_key(key):
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
         salt=b'\xe4(\x7f)FQWM:cOW\x97\x86\xe7\x86',
         iterations=390000,
     )
-    return base64.urlsafe_b64encode(kdf.derive(key.encode('utf-8')))
+    return kdf.derive(str(key).encode('utf-8'))
+
+
+def cipher_keygen(key):
+    """
+    Returns the Fernet key and the stream cipher of a key from a single derivation
+    """
+    derived = _derive_key(key)
+    return KeyCiphers(base64.urlsafe_b64encode(derived), AESGCM(derived))
 
 
 def sha3_digest(key):
     sha3 = hashlib.sha3_512()
-    sha3.update(str.encode(key))
+    sha3.update(str(key).encode('utf-8'))
     return sha3.hexdigest()
 
 
@@ -29,3 +53,87 @@ def encrypt_text(text, key):
 def decrypt_text(text, key):
     fernet = Fernet(key)
     return fernet.decrypt(text).decode('utf-8')
+
+
+def _iter_chunks(src, chunk_size):
+    # memory-mapped and in-memory buffers are sliced without copying
+    if not hasattr(src, 'read'):
+        view = memoryview(src)
+        for i in range(0, len(view), chunk_size):
+            yield view[i : i + chunk_size]
+        return
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _chunk_nonce(prefix, idx):
+    return prefix + struct.pack('>I', idx)
+
+
+def _chunk_aad(idx, is_final):
+    return struct.pack('>I?', idx, is_final)
+
+
+def _read_exact(src, size):
+    data = src.read(size)
+    if len(data) != size:
+        raise ValueError('encrypted stream is truncated')
+    return data
+
+
+def encrypt_stream(src, dst, key, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    src: readable file-like object, or buffer such as bytes or mmap.mmap
+    dst: writable binary file-like object
+    key [AESGCM]: stream cipher returned by cipher_keygen
+    chunk_size [int]: number of plaintext bytes per authenticated chunk
+    """
+    prefix = os.urandom(STREAM_NONCE_PREFIX_SIZE)
+    dst.write(STREAM_MAGIC + prefix + struct.pack('>I', chunk_size))
+
+    idx = 0
+    chunks = _iter_chunks(src, chunk_size)
+    chunk = next(chunks, b'')
+    while True:
+        # look one chunk ahead so that the last chunk is authenticated as final
+        next_chunk = next(chunks, None)
+        is_final = next_chunk is None
+        ct = key.encrypt(_chunk_nonce(prefix, idx), chunk, _chunk_aad(idx, is_final))
+        header = len(ct) | (STREAM_FINAL_FLAG if is_final else 0)
+        dst.write(struct.pack('>I', header))
+        dst.write(ct)
+        if is_final:
+            return
+        chunk = next_chunk
+        idx += 1
+
+
+def decrypt_stream(src, dst, key):
+    """
+    src: readable binary file-like object produced by encrypt_stream
+    dst: writable binary file-like object
+    key [AESGCM]: stream cipher returned by cipher_keygen
+    """
+    header = _read_exact(src, len(STREAM_MAGIC) + STREAM_NONCE_PREFIX_SIZE + 4)
+    if header[: len(STREAM_MAGIC)] != STREAM_MAGIC:
+        raise ValueError('not an encrypted stream')
+    prefix = header[len(STREAM_MAGIC) : len(STREAM_MAGIC) + STREAM_NONCE_PREFIX_SIZE]
+    (chunk_size,) = struct.unpack('>I', header[-4:])
+
+    idx = 0
+    while True:
+        (chunk_header,) = struct.unpack('>I', _read_exact(src, 4))
+        is_final = bool(chunk_header & STREAM_FINAL_FLAG)
+        ct_size = chunk_header & ~STREAM_FINAL_FLAG
+        if ct_size > chunk_size + STREAM_TAG_SIZE:
+            raise ValueError('encrypted chunk exceeds the stream chunk size')
+        ct = _read_exact(src, ct_size)
+        dst.write(key.decrypt(_chunk_nonce(prefix, idx), ct, _chunk_aad(idx, is_final)))
+        if is_final:
+            if src.read(1):
+                raise ValueError('trailing data after the final chunk')
+            return
+        idx += 1
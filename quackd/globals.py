@@ -14,3 +14,37 @@ B92_DEFAULT_KWARGS = dict(
     meas_err_mitig=True,
     n_shots=100
 )
+
+B92_THRESHOLD = 0.3
+B92_CASCADE_ITERS = 5
+
+BACKEND_MAX_FAILURES = 3
+BACKEND_COOLDOWN = 300
+BACKEND_EWMA_ALPHA = 0.3
+# seconds to wait for the results of a QKD job before failing over
+BACKEND_JOB_TIMEOUT = 600
+
+STREAM_CHUNK_SIZE = 1 << 20
+
+# keys never expire unless a TTL is configured
+KEY_TTL = None
+KEY_MAX_PER_HOST = 256
+KEY_SWEEP_INTERVAL = 60
+KEY_TOMBSTONE_TTL = 60 * 60
+
+KC_PAGE_SIZE = 20
+
+CAL_INTERVAL = 6 * 60 * 60
+CAL_N_SHOTS = 1024
+CAL_RB_SEEDS = 2
+CAL_RB_LENGTHS = [1, 10, 20, 50, 100]
+
+STORE_TIMEOUT = 30
+WORKER_POLL_INTERVAL = 1
+WORKER_MAX_BACKOFF = 60
+
+PROFILE_DIR = 'profiles'
+PROFILE_DEFAULT_N = 10
+
+SWEEP_DIR = 'sweeps'
+SWEEP_FLUSH_ROWS = 256
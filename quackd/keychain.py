@@ -1,93 +1,328 @@
-import copy
-from datetime import datetime
-import json
+from contextlib import contextmanager
+from datetime import timedelta
+import heapq
+import threading
 
 from b92 import B92
-from crypto import sha3_digest
+from crypto import cipher_keygen, sha3_digest
 from globals import *
+from store import GROUP_HOST, GroupRef, KeyEntry, NULL_ENTRY, open_store
 from utils import timestamp
 
 
 class KeyChain:
-    def __init__(self, keychain_path=None, **b92_kwargs):
+    def __init__(
+        self,
+        backend_pool,
+        keychain_path=None,
+        key_ttl=KEY_TTL,
+        max_keys_per_host=KEY_MAX_PER_HOST,
+        tombstone_ttl=KEY_TOMBSTONE_TTL,
+        calibrator=None,
+        **b92_kwargs
+    ):
+        """
+        keychain_path [str]: keychain file, or an SQLite database (.db, .sqlite)
+                             to share the keychain between worker processes
+        calibrator [Calibrator]: source of published calibration tables, if any
+        key_ttl [float]: seconds after enrollment before a key expires, or None
+        max_keys_per_host [int]: keys kept per local keychain before the oldest
+                                 is evicted, or None
+        tombstone_ttl [float]: seconds deletions are kept in a shared keychain for
+                               other workers to pick up; every worker must sweep
+                               more often than this
+        """
+        self.backend_pool = backend_pool
         self.keychain_path=keychain_path
+        self.key_ttl = None if key_ttl is None else timedelta(seconds=key_ttl)
+        self.max_keys_per_host = max_keys_per_host
+        self.tombstone_ttl = timedelta(seconds=tombstone_ttl)
+        self.calibrator = calibrator
         self.b92_kwargs = b92_kwargs
         self.keychain = {}
+        # hosts referencing each group entry, by (src, dst)
+        self._group_members = {}
+        # ciphers derived from entries, by the (host, idx) slot owning the entry,
+        # dropped along with the entry
+        self._ciphers = {}
+        # heap of (ts, host, idx) ordering entries by enrollment time; entries
+        # replaced or evicted since being pushed are skipped when popped
+        self._expiry = []
+        self._lock = threading.RLock()
+        self._sweeper = None
+        self.store = open_store(keychain_path)
         try:
-            self._load_keychain()
+            self.keychain = self.store.load()
         except OSError:
             return
+        self._resolve_groups()
+        if self.key_ttl is None:
+            return
+        self._expiry = [
+            (entry.ts, host, idx)
+            for host, kc_local in self.keychain.items()
+            for idx, entry in kc_local.items()
+        ]
+        # expired keys are hidden from queries right away, but only deleted by
+        # sweeps, so that loading a keychain never rewrites it
+        heapq.heapify(self._expiry)
 
 
-    def _save_keychain(self):
-        if self.keychain_path is None:
-            return
-        kc_temp = {}
+    def _resolve_groups(self):
+        groups = self.keychain.get(GROUP_HOST, {})
         for host, kc_local in self.keychain.items():
-            kc_temp[host] = {}
-            for (src, dst), (key, ts) in kc_local.items():
-                kc_temp[host][f'{src}+{dst}'] = (key, datetime.isoformat(ts))
-        with open(self.keychain_path, 'w') as f:
-            json.dump(kc_temp, f, sort_keys=False, indent=4)
+            for idx, entry in list(kc_local.items()):
+                if not isinstance(entry, GroupRef):
+                    continue
+                if idx in groups:
+                    kc_local[idx] = groups[idx]
+                    self._group_members.setdefault(idx, set()).add(host)
+                else:
+                    del kc_local[idx]
 
 
-    def _load_keychain(self):
-        if self.keychain_path is None:
-            return
-        with open(self.keychain_path, 'r') as f:
-            kc_temp = json.load(f)
-        kc = {}
-        for host, kc_local in kc_temp.items():
-            kc[host] = {}
-            for src_dst, (key, ts_iso) in kc_local.items():
-                kc[host][tuple(src_dst.split('+'))] = (
-                    key, datetime.fromisoformat(ts_iso)
-                )
-        self.keychain = kc
+    def _is_group_ref(self, host, idx, entry):
+        return host != GROUP_HOST and entry is self.keychain.get(GROUP_HOST, {}).get(idx)
+
+
+    def _release(self, txn, host, idx, entry):
+        """
+        Drops what depends on an entry leaving the slot (host, idx), deleting a
+        group entry once its last member leaves
+        """
+        self._ciphers.pop((host, idx), None)
+        if host == GROUP_HOST:
+            self._group_members.pop(idx, None)
+        elif self._is_group_ref(host, idx, entry):
+            members = self._group_members.get(idx, set())
+            members.discard(host)
+            # other workers delete the group entry themselves
+            if not members and txn is not None:
+                self._delete(txn, GROUP_HOST, idx)
+
+
+    def _put(self, txn, host, idx, entry):
+        kc_local = self.keychain.setdefault(host, {})
+        # re-insert so that local keychains stay ordered oldest first
+        if idx in kc_local:
+            self._release(txn, host, idx, kc_local.pop(idx))
+        kc_local[idx] = entry
+        is_ref = self._is_group_ref(host, idx, entry)
+        if is_ref:
+            self._group_members.setdefault(idx, set()).add(host)
+        if self.key_ttl is not None:
+            heapq.heappush(self._expiry, (entry.ts, host, idx))
+        if txn is not None:
+            txn.put(host, idx, GroupRef(entry.ts) if is_ref else entry)
+
+
+    def _delete(self, txn, host, idx):
+        kc_local = self.keychain.get(host, {})
+        if idx in kc_local:
+            self._release(txn, host, idx, kc_local.pop(idx))
+        if txn is not None:
+            txn.delete(host, idx)
+
+
+    def _apply(self, changes):
+        for host, idx, entry in changes:
+            if entry is None:
+                self._delete(None, host, idx)
+            elif isinstance(entry, GroupRef):
+                group = self.keychain.get(GROUP_HOST, {}).get(idx)
+                if group is not None and group.ts == entry.ts:
+                    self._put(None, host, idx, group)
+            else:
+                self._put(None, host, idx, entry)
+
+
+    def _sync(self):
+        with self._lock:
+            self._apply(self.store.changes())
+
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock, self.store.transaction(self.keychain) as txn:
+            # catch up with other workers before deciding on evictions
+            self._apply(txn.remote)
+            yield txn
 
 
     def add(self, host, members, src, dst, key, pbar):
-        sent_key, recv_key = self.qkd(key, pbar)
+        backend, (sent_key, recv_key, calibration) = self.qkd(key, pbar)
         if len(sent_key) >= KEY_MIN_SIZE:
-            self.enroll(host, src, dst, sent_key)
+            self.enroll(host, src, dst, sent_key, backend, calibration)
             if len(recv_key) >= KEY_MIN_SIZE:
-                for m in members:
-                    self.enroll(m, src, dst, recv_key)
-        return sent_key, recv_key
+                self.enroll_group(members, src, dst, recv_key, backend, calibration)
+        return sent_key, recv_key, backend
 
 
-    def enroll(self, host, src, dst, key):
-        if host not in self.keychain:
-            self.keychain[host] = {}
-        idx = (src, dst)
-        self.keychain[host][idx] = (key, timestamp())
-        try:
-            self._save_keychain()
-        except OSError:
+    def _evict(self, txn, host):
+        if self.max_keys_per_host is None:
             return
+        kc_local = self.keychain[host]
+        while len(kc_local) > self.max_keys_per_host:
+            self._delete(txn, host, next(iter(kc_local)))
+
+
+    def enroll(self, host, src, dst, key, backend=None, calibration=None):
+        with self._transaction() as txn:
+            entry = KeyEntry(key, timestamp(), backend, sha3_digest(key), calibration)
+            self._put(txn, host, (src, dst), entry)
+            self._evict(txn, host)
+
+
+    def enroll_group(self, hosts, src, dst, key, backend=None, calibration=None):
+        """
+        Enrolls a key shared by all hosts in a single transaction. The key is
+        stored once as the group entry of (src, dst), which the hosts' local
+        keychains reference, and replaces the previous group of (src, dst).
+        """
+        idx = (src, dst)
+        entry = KeyEntry(key, timestamp(), backend, sha3_digest(key), calibration)
+        with self._transaction() as txn:
+            # members of the previous group who aren't in the new one hold a key
+            # the sender no longer uses
+            for host in self._group_members.get(idx, set()) - set(hosts):
+                self._delete(txn, host, idx)
+            self._put(txn, GROUP_HOST, idx, entry)
+            for host in hosts:
+                self._put(txn, host, idx, entry)
+                self._evict(txn, host)
+
+
+    def _is_expired(self, ts, now):
+        return self.key_ttl is not None and ts + self.key_ttl <= now
+
+
+    def _get(self, host, idx, now):
+        entry = self.keychain.get(host, {}).get(idx, NULL_ENTRY)
+        # expired keys are unusable even before the sweeper removes them
+        if entry.ts is not None and self._is_expired(entry.ts, now):
+            return NULL_ENTRY
+        return entry
 
 
     def query(self, host, src, dst):
-        if host not in self.keychain:
-            return (None, None)
+        self._sync()
+        with self._lock:
+            return self._get(host, (src, dst), timestamp())
+
+
+    def lookup(self, hosts, src, dst):
+        """
+        Returns an (entry, ciphers) pair for each host after a single sync, or
+        (NULL_ENTRY, None) for hosts without a usable key. Ciphers are derived
+        once per entry and kept until the entry is removed, so all members of
+        a group share them.
+        """
+        self._sync()
+        now = timestamp()
         idx = (src, dst)
-        return self.keychain[host].get(idx, (None, None))
+        pairs = []
+        with self._lock:
+            for host in hosts:
+                entry = self._get(host, idx, now)
+                if entry.ts is None:
+                    pairs.append((NULL_ENTRY, None))
+                    continue
+                owner = GROUP_HOST if self._is_group_ref(host, idx, entry) else host
+                ciphers = self._ciphers.get((owner, idx))
+                if ciphers is None:
+                    ciphers = cipher_keygen(entry.key)
+                    self._ciphers[(owner, idx)] = ciphers
+                pairs.append((entry, ciphers))
+        return pairs
+
+
+    def sweep(self):
+        """
+        Deletes expired keys and purges tombstones older than tombstone_ttl.
+        Sweeping also syncs with other workers, so that none of them misses a
+        deletion whose tombstone was purged.
+        """
+        now = timestamp()
+        n_expired = 0
+        with self._transaction() as txn:
+            while self._expiry and self._is_expired(self._expiry[0][0], now):
+                ts, host, idx = heapq.heappop(self._expiry)
+                entry = self.keychain.get(host, {}).get(idx)
+                if entry is not None and entry.ts == ts:
+                    self._delete(txn, host, idx)
+                    n_expired += 1
+            self.store.purge(now - self.tombstone_ttl)
+        return n_expired
+
+
+    def start_sweeper(self, interval=KEY_SWEEP_INTERVAL):
+        def run():
+            while not self._sweeper_stop.wait(interval):
+                self.sweep()
+
+        self._sweeper_stop = threading.Event()
+        self._sweeper = threading.Thread(target=run, daemon=True)
+        self._sweeper.start()
+
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper_stop.set()
+            self._sweeper.join()
+            self._sweeper = None
 
 
     def validate(self, h_val, src, dst):
-        sent_key = self.query(src, src, dst)
+        """
+        Checks a digest against the sender's entry as of the last sync, so that
+        validating every row of a keychain page doesn't poll the store per row
+        """
+        # the sender's own entry for (src, dst) carries the reference digest
+        with self._lock:
+            h_sent = self._get(src, (src, dst), timestamp()).digest
 
-        if sent_key is not None:
-            h_sent = sha3_digest(sent_key[0])
+        if h_sent is not None:
             return h_val == h_sent, h_val[:6], h_sent[:6]
         else:
             return False, h_val[:6], None
 
 
-    def get_keychain(self, host):
-        return copy.deepcopy(self.keychain.get(host))
+    def get_keychain(self, host, offset=0, limit=None):
+        """
+        Returns a page of (idx, entry) pairs of a local keychain, oldest first,
+        along with the total number of entries, or (None, 0) if the local
+        keychain doesn't exist. Entries are immutable and shared, not copied.
+        """
+        self._sync()
+        now = timestamp()
+        with self._lock:
+            kc_local = self.keychain.get(host)
+            if kc_local is None:
+                return None, 0
+            items = [
+                (idx, entry) for idx, entry in kc_local.items()
+                if not self._is_expired(entry.ts, now)
+            ]
+        stop = None if limit is None else offset + limit
+        return items[offset:stop], len(items)
 
 
     def qkd(self, key, pbar):
-        scheme = B92(key, pbar, **self.b92_kwargs)
-        return scheme.get_key_pair()
+        def run(name, backend):
+            pbar.pos = 0
+            if self.calibrator is None:
+                scheme = B92(key, pbar, backend=backend, **self.b92_kwargs)
+                return (*scheme.get_key_pair(), None)
+            # QKD jobs hold off calibration rounds and use the latest table as is
+            with self.calibrator.hold():
+                table = self.calibrator.get_table(name)
+                scheme = B92(
+                    key, pbar, backend=backend, calibration=table, **self.b92_kwargs
+                )
+                version = None if table is None else table.version
+                return (*scheme.get_key_pair(), version)
+
+        def on_failure(name, e):
+            pbar.log(f'Backend {name} failed ({type(e).__name__}), failing over')
+
+        return self.backend_pool.run(run, on_failure)
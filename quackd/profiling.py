@@ -0,0 +1,109 @@
+import cProfile
+import functools
+import itertools
+import os
+import threading
+import time
+
+from globals import *
+
+
+class Profiler:
+    """
+    Profiles the next n invocations of selected targets with cProfile and dumps
+    one .pstats file per invocation, which flameprof, snakeviz or gprof2dot can
+    render. Targets are dotted names such as 'qkd' or 'b92.cascade'; enabling
+    'b92' covers every 'b92.*' target. Wrapped functions only check for an empty
+    dict while nothing is enabled.
+    """
+    def __init__(self, profile_dir=PROFILE_DIR):
+        self.profile_dir = profile_dir
+        self.targets = set()
+        self._remaining = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # cProfile can't nest, so calls made while profiling aren't profiled again
+        self._active = threading.local()
+
+
+    def _match(self, target):
+        return [
+            t for t in self.targets if t == target or t.startswith(f'{target}.')
+        ]
+
+
+    def enable(self, target, n):
+        matched = self._match(target)
+        with self._lock:
+            for t in matched:
+                self._remaining[t] = n
+        return matched
+
+
+    def disable(self, target=None):
+        with self._lock:
+            if target is None:
+                self._remaining.clear()
+                return
+            for t in self._match(target):
+                self._remaining.pop(t, None)
+
+
+    def enable_from_spec(self, spec):
+        """
+        spec [str]: comma-separated targets with optional counts, e.g. 'qkd:5,b92'
+        """
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            target, _, n = item.partition(':')
+            self.enable(target.strip(), int(n) if n else PROFILE_DEFAULT_N)
+
+
+    def _claim(self, target):
+        with self._lock:
+            n = self._remaining.get(target, 0)
+            if n <= 0:
+                return False
+            if n == 1:
+                del self._remaining[target]
+            else:
+                self._remaining[target] = n - 1
+            return True
+
+
+    def _dump(self, prof, target):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f'{target}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{next(self._seq)}.pstats'
+        prof.dump_stats(os.path.join(self.profile_dir, name))
+
+
+    def wrap(self, target):
+        self.targets.add(target)
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self._remaining or getattr(self._active, 'on', False):
+                    return fn(*args, **kwargs)
+                if not self._claim(target):
+                    return fn(*args, **kwargs)
+                prof = cProfile.Profile()
+                try:
+                    prof.enable()
+                except ValueError:
+                    # another thread holds the interpreter-wide profiler
+                    return fn(*args, **kwargs)
+                self._active.on = True
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    prof.disable()
+                    self._active.on = False
+                    self._dump(prof, target)
+            return wrapper
+
+        return decorator
+
+
+profiler = Profiler(os.environ.get('QUACKD_PROFILE_DIR', PROFILE_DIR))
@@ -0,0 +1,348 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import os
+import sqlite3
+import struct
+
+from bitkey import BitKey
+from crypto import sha3_digest
+from globals import *
+from utils import timestamp
+
+
+KeyEntry = namedtuple(
+    'KeyEntry', ['key', 'ts', 'backend', 'digest', 'calibration']
+)
+NULL_ENTRY = KeyEntry(None, None, None, None, None)
+
+# keys shared by a group are stored once under GROUP_HOST, and the local
+# keychains of its members only hold a GroupRef to that entry
+GROUP_HOST = ''
+GroupRef = namedtuple('GroupRef', ['ts'])
+
+KEYCHAIN_MAGIC = b'QKC4'
+# keychains written before digests (QKC1), calibration versions (QKC2) and
+# group references (QKC3) were stored alongside keys
+KEYCHAIN_MAGIC_V1 = b'QKC1'
+KEYCHAIN_MAGIC_V2 = b'QKC2'
+KEYCHAIN_MAGIC_V3 = b'QKC3'
+KEYCHAIN_MAGICS = (
+    KEYCHAIN_MAGIC, KEYCHAIN_MAGIC_V1, KEYCHAIN_MAGIC_V2, KEYCHAIN_MAGIC_V3
+)
+DIGEST_SIZE = 64
+
+SHARED_STORE_EXTS = ('.db', '.sqlite', '.sqlite3')
+
+
+def _write_str(f, s):
+    data = s.encode('utf-8')
+    f.write(struct.pack('>H', len(data)))
+    f.write(data)
+
+
+def _read_str(f):
+    (n,) = struct.unpack('>H', f.read(2))
+    return f.read(n).decode('utf-8')
+
+
+def _write_key(f, key):
+    f.write(struct.pack('>I', len(key)))
+    f.write(key.to_bytes())
+
+
+def _read_key(f):
+    (n,) = struct.unpack('>I', f.read(4))
+    return BitKey.from_bytes(f.read((n + 7) // 8), n)
+
+
+def is_shared_store(path):
+    return path is not None and os.path.splitext(path)[1] in SHARED_STORE_EXTS
+
+
+def open_store(path):
+    if is_shared_store(path):
+        return SQLiteKeyStore(path)
+    return FileKeyStore(path)
+
+
+class StoreTransaction:
+    def __init__(self, remote):
+        # changes committed by other processes since this process last synced
+        self.remote = remote
+        self.puts = []
+        self.deletes = []
+
+
+    def put(self, host, idx, entry):
+        self.puts.append((host, idx, entry))
+
+
+    def delete(self, host, idx):
+        self.deletes.append((host, idx))
+
+
+class FileKeyStore:
+    """
+    Keychain persisted to a single file owned by one process, rewritten on
+    every transaction
+    """
+    def __init__(self, path):
+        self.path = path
+
+
+    def load(self):
+        if self.path is None:
+            return {}
+        with open(self.path, 'rb') as f:
+            magic = f.read(len(KEYCHAIN_MAGIC))
+            if magic not in KEYCHAIN_MAGICS:
+                return self._load_legacy()
+            (n_entries,) = struct.unpack('>I', f.read(4))
+            kc = {}
+            for _ in range(n_entries):
+                host, src, dst, backend = [_read_str(f) for _ in range(4)]
+                (ts,) = struct.unpack('>d', f.read(8))
+                ts = datetime.fromtimestamp(ts, timezone.utc)
+                if magic == KEYCHAIN_MAGIC and f.read(1) == b'\x01':
+                    kc.setdefault(host, {})[(src, dst)] = GroupRef(ts)
+                    continue
+                key = _read_key(f)
+                if magic == KEYCHAIN_MAGIC_V1:
+                    digest = sha3_digest(key)
+                else:
+                    digest = f.read(DIGEST_SIZE).hex()
+                calibration = None
+                if magic in (KEYCHAIN_MAGIC, KEYCHAIN_MAGIC_V3):
+                    (calibration,) = struct.unpack('>i', f.read(4))
+                kc.setdefault(host, {})[(src, dst)] = KeyEntry(
+                    key,
+                    ts,
+                    backend or None,
+                    digest,
+                    None if calibration == -1 else calibration
+                )
+        return kc
+
+
+    def _load_legacy(self):
+        # JSON keychains are converted to the binary layout on the next save
+        with open(self.path, 'r') as f:
+            kc_temp = json.load(f)
+        kc = {}
+        for host, kc_local in kc_temp.items():
+            kc[host] = {}
+            for src_dst, (key, ts_iso, *backend) in kc_local.items():
+                # keychains saved before backend pooling carry no backend
+                kc[host][tuple(src_dst.split('+'))] = KeyEntry(
+                    BitKey(key), datetime.fromisoformat(ts_iso),
+                    backend[0] if backend else None,
+                    sha3_digest(key),
+                    None
+                )
+        return kc
+
+
+    def _save(self, keychain):
+        """
+        Binary layout: magic, entry count, then per entry the host, source,
+        destination and backend as length-prefixed UTF-8, the POSIX timestamp
+        as a double and a byte set for group references. Other entries go on
+        with the key as a bit count followed by the packed bits, the raw
+        SHA3-512 digest of the key and the calibration version (-1 if none).
+        """
+        if self.path is None:
+            return
+        groups = keychain.get(GROUP_HOST, {})
+        n_entries = sum(len(kc_local) for kc_local in keychain.values())
+        path_temp = f'{self.path}.tmp'
+        with open(path_temp, 'wb') as f:
+            f.write(KEYCHAIN_MAGIC)
+            f.write(struct.pack('>I', n_entries))
+            for host, kc_local in keychain.items():
+                for (src, dst), entry in kc_local.items():
+                    for s in (host, src, dst, entry.backend or ''):
+                        _write_str(f, s)
+                    f.write(struct.pack('>d', entry.ts.timestamp()))
+                    is_ref = host != GROUP_HOST and entry is groups.get((src, dst))
+                    f.write(b'\x01' if is_ref else b'\x00')
+                    if is_ref:
+                        continue
+                    _write_key(f, entry.key)
+                    f.write(bytes.fromhex(entry.digest))
+                    calibration = entry.calibration
+                    f.write(struct.pack('>i', -1 if calibration is None else calibration))
+        os.replace(path_temp, self.path)
+
+
+    def changes(self):
+        return []
+
+
+    def purge(self, before):
+        return
+
+
+    @contextmanager
+    def transaction(self, keychain):
+        txn = StoreTransaction([])
+        yield txn
+        if txn.puts or txn.deletes:
+            try:
+                self._save(keychain)
+            except OSError:
+                return
+
+
+class SQLiteKeyStore:
+    """
+    Keychain shared by several processes through an SQLite database. Writes
+    run in immediate transactions, so they are serialized across processes.
+    Every write bumps a global sequence number, and deletions leave tombstones
+    until purged. Rows of group members only flag a reference to the group.
+    Other processes pick up changes by polling the database's data version,
+    which only moves when another connection commits. Callers must serialize
+    access from threads of the same process.
+    """
+    def __init__(self, path, timeout=STORE_TIMEOUT):
+        self.path = path
+        self._conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS keys (
+                host TEXT NOT NULL,
+                src TEXT NOT NULL,
+                dst TEXT NOT NULL,
+                key_len INTEGER,
+                key BLOB,
+                ts REAL NOT NULL,
+                backend TEXT,
+                digest BLOB,
+                calibration INTEGER,
+                seq INTEGER NOT NULL,
+                grp INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (host, src, dst)
+            );
+            CREATE INDEX IF NOT EXISTS keys_seq ON keys (seq);
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta VALUES ('seq', 0);
+        ''')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(keys)')]
+        if 'grp' not in columns:
+            # databases created before group references
+            self._conn.execute('ALTER TABLE keys ADD COLUMN grp INTEGER NOT NULL DEFAULT 0')
+        self._seq = 0
+        self._data_version = None
+
+
+    def _row_to_change(self, row):
+        host, src, dst, key_len, key, ts, backend, digest, calibration, grp, _ = row
+        ts = datetime.fromtimestamp(ts, timezone.utc)
+        if grp:
+            return host, (src, dst), GroupRef(ts)
+        if key is None:
+            return host, (src, dst), None
+        return host, (src, dst), KeyEntry(
+            BitKey.from_bytes(key, key_len),
+            ts,
+            backend,
+            digest.hex(),
+            calibration
+        )
+
+
+    def _select(self, where, params):
+        return self._conn.execute(
+            'SELECT host, src, dst, key_len, key, ts, backend, digest, calibration, grp, seq '
+            f'FROM keys WHERE {where}', params
+        ).fetchall()
+
+
+    def _read_seq(self):
+        return self._conn.execute(
+            'SELECT value FROM meta WHERE name = \'seq\''
+        ).fetchone()[0]
+
+
+    def load(self):
+        self._data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        # read the keys and the sequence number from the same snapshot
+        self._conn.execute('BEGIN')
+        try:
+            self._seq = self._read_seq()
+            # oldest first, matching the order of local keychains
+            rows = self._select('key IS NOT NULL OR grp = 1 ORDER BY ts', ())
+        finally:
+            self._conn.execute('COMMIT')
+        kc = {}
+        for row in rows:
+            host, idx, entry = self._row_to_change(row)
+            kc.setdefault(host, {})[idx] = entry
+        return kc
+
+
+    def changes(self):
+        data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return []
+        self._data_version = data_version
+        rows = self._select('seq > ? ORDER BY seq', (self._seq,))
+        # only advance past rows actually read, as other workers may commit
+        # between this read and any later one
+        if rows:
+            self._seq = rows[-1][-1]
+        return [self._row_to_change(row) for row in rows]
+
+
+    def purge(self, before):
+        self._conn.execute(
+            'DELETE FROM keys WHERE key IS NULL AND grp = 0 AND ts < ?',
+            (before.timestamp(),)
+        )
+
+
+    @contextmanager
+    def transaction(self, keychain):
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            txn = StoreTransaction(self.changes())
+            yield txn
+            # continue from the last sequence number issued, which may belong to
+            # a purged tombstone; every row up to it was read by changes()
+            seq = self._read_seq()
+            for host, (src, dst), entry in txn.puts:
+                seq += 1
+                if isinstance(entry, GroupRef):
+                    values = (host, src, dst, None, None, entry.ts.timestamp(),
+                              None, None, None, seq, 1)
+                else:
+                    values = (host, src, dst, len(entry.key), entry.key.to_bytes(),
+                              entry.ts.timestamp(), entry.backend,
+                              bytes.fromhex(entry.digest), entry.calibration, seq, 0)
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO keys (host, src, dst, key_len, key, ts, '
+                    'backend, digest, calibration, seq, grp) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    values
+                )
+            now = timestamp().timestamp()
+            for host, (src, dst) in txn.deletes:
+                seq += 1
+                self._conn.execute(
+                    'UPDATE keys SET key_len = NULL, key = NULL, ts = ?, digest = NULL, '
+                    'grp = 0, seq = ? WHERE host = ? AND src = ? AND dst = ?',
+                    (now, seq, host, src, dst)
+                )
+            if txn.puts or txn.deletes:
+                self._conn.execute('UPDATE meta SET value = ? WHERE name = \'seq\'', (seq,))
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._seq = seq
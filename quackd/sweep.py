@@ -0,0 +1,237 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import itertools
+import os
+
+import numpy as np
+
+from b92 import B92
+from globals import *
+
+
+SWEEP_PARAMS = ['error_rate', 'eve_fraction', 'n_shots', 'threshold', 'num_cascade_iters']
+SWEEP_COLUMNS = SWEEP_PARAMS + [
+    'seed', 'n_bits', 'sifted', 'qber', 'residual_error', 'parity_checks',
+    'agreed', 'key_rate'
+]
+
+
+class _NullPbar:
+    pos = 0
+
+    def log(self, msg):
+        return
+
+
+class LocalB92(B92):
+    """
+    B92 whose measurements are sampled locally instead of run as circuits.
+    Every shot is read out flipped with probability error_rate, and a fraction
+    eve_fraction of shots is intercepted by an eavesdropper who measures in a
+    random basis and resends the state she observed.
+    """
+    def __init__(self, alice_string, error_rate=0.0, eve_fraction=0.0, **b92_kwargs):
+        self.error_rate = error_rate
+        self.eve_fraction = eve_fraction
+        super().__init__(
+            alice_string, _NullPbar(), backend=None, meas_err_mitig=False, **b92_kwargs
+        )
+
+    def build_circuit_n(self):
+        # Alice sends |0> for 0 and |+> for 1, so Bob measures eigenvalue -1 with
+        # probability 1/2 unless his basis matches her state; intercept-resend
+        # raises that probability from 0 to eve_fraction / 4
+        match = (self.alice_bits == 1) == (np.char.upper(self.bob_bases) == 'X')
+        p = np.where(match, self.eve_fraction / 4, 0.5)
+        p = p * (1 - self.error_rate) + (1 - p) * self.error_rate
+        self.sift(np.random.binomial(self.n_shots, p))
+
+
+def run_point(point, n_bits, seed):
+    """
+    point [dict]: values of SWEEP_PARAMS
+    n_bits [int]: length of Alice's bit string
+    seed [int]: seed for Alice's bits, Bob's bases and the sampled shots
+    """
+    np.random.seed(seed)
+    alice_string = ''.join(np.random.choice(['0', '1'], n_bits))
+    scheme = LocalB92(alice_string, **point)
+    sent_key, recv_key = scheme.get_key_pair()
+    # bits disclosed by cascade parity checks are no longer secret
+    parity_checks = scheme.parity_checks[-1]
+    agreed = scheme.N > 0 and sent_key == recv_key
+    return dict(
+        point,
+        seed=seed,
+        n_bits=n_bits,
+        sifted=scheme.N / n_bits,
+        qber=scheme.Q if scheme.N else np.nan,
+        residual_error=scheme.errors[-1] if scheme.N else np.nan,
+        parity_checks=parity_checks,
+        agreed=agreed,
+        key_rate=max(scheme.N - parity_checks, 0) / n_bits if agreed else 0.0
+    )
+
+
+def _run_task(task):
+    return run_point(*task)
+
+
+class SweepWriter:
+    """
+    Streams sweep results to a directory of NumPy row groups. Every flush
+    writes the buffered rows as one part-NNNNN.npz with an array per column,
+    continuing the numbering of parts already in the directory.
+    """
+    def __init__(self, sweep_dir, flush_rows=SWEEP_FLUSH_ROWS):
+        self.sweep_dir = sweep_dir
+        self.flush_rows = flush_rows
+        os.makedirs(self.sweep_dir, exist_ok=True)
+        self._n_parts = len(glob.glob(os.path.join(self.sweep_dir, 'part-*.npz')))
+        self._rows = []
+
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.flush_rows:
+            self.flush()
+
+
+    def flush(self):
+        if not self._rows:
+            return
+        path = os.path.join(self.sweep_dir, f'part-{self._n_parts:05d}.npz')
+        # write atomically, so that readers never load a partial part
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f, **{c: np.array([r[c] for r in self._rows]) for c in SWEEP_COLUMNS})
+        os.replace(f'{path}.tmp', path)
+        self._n_parts += 1
+        self._rows = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def load_sweep(sweep_dir):
+    """
+    Returns a dict mapping each column to the concatenated results of all parts
+    """
+    parts = sorted(glob.glob(os.path.join(sweep_dir, 'part-*.npz')))
+    columns = {c: [] for c in SWEEP_COLUMNS}
+    for path in parts:
+        with np.load(path) as data:
+            for c in SWEEP_COLUMNS:
+                columns[c].append(data[c])
+    return {c: np.concatenate(v) if v else np.zeros(0) for c, v in columns.items()}
+
+
+def sweep(grid, sweep_dir, n_bits=KEY_INIT_SIZE, n_repeats=1, seed=0, n_workers=None):
+    """
+    Runs every combination of the values in grid n_repeats times across a
+    process pool and streams the results to sweep_dir
+
+    grid [dict]: list of values for each of SWEEP_PARAMS
+    n_workers [int]: number of processes; defaults to the number of CPUs
+    """
+    points = [
+        dict(zip(SWEEP_PARAMS, values))
+        for values in itertools.product(*(grid[p] for p in SWEEP_PARAMS))
+    ]
+    tasks = [
+        (point, n_bits, seed + i * n_repeats + j)
+        for i, point in enumerate(points)
+        for j in range(n_repeats)
+    ]
+    n_workers = n_workers or os.cpu_count()
+    with ProcessPoolExecutor(n_workers) as executor, SweepWriter(sweep_dir) as writer:
+        chunksize = max(len(tasks) // (4 * n_workers), 1)
+        for row in executor.map(_run_task, tasks, chunksize=chunksize):
+            writer.write(row)
+    return len(tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'sweep_dir',
+        nargs='?',
+        default=SWEEP_DIR,
+        help='specify directory to which sweep results are written'
+    )
+    parser.add_argument(
+        '--error_rates',
+        nargs='+',
+        type=float,
+        default=[0.0],
+        help='specify per-shot readout error rates'
+    )
+    parser.add_argument(
+        '--eve_fractions',
+        nargs='+',
+        type=float,
+        default=[0.0],
+        help='specify fractions of shots intercepted and resent by an eavesdropper'
+    )
+    parser.add_argument(
+        '--n_shots',
+        nargs='+',
+        type=int,
+        default=[B92_DEFAULT_KWARGS['n_shots']],
+        help='specify numbers of shots per circuit'
+    )
+    parser.add_argument(
+        '--thresholds',
+        nargs='+',
+        type=float,
+        default=[B92_THRESHOLD],
+        help='specify sifting thresholds as fractions of shots'
+    )
+    parser.add_argument(
+        '--cascade_iters',
+        nargs='+',
+        type=int,
+        default=[B92_CASCADE_ITERS],
+        help='specify numbers of cascade passes'
+    )
+    parser.add_argument(
+        '--n_bits', '-n',
+        type=int,
+        default=KEY_INIT_SIZE,
+        help='specify length of the bit string sent by Alice'
+    )
+    parser.add_argument(
+        '--repeats', '-r',
+        type=int,
+        default=1,
+        help='specify number of runs per grid point'
+    )
+    parser.add_argument(
+        '--seed', '-s',
+        type=int,
+        default=0,
+        help='specify seed of the first run'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        help='specify number of worker processes'
+    )
+    args = parser.parse_args()
+
+    grid = dict(
+        error_rate=args.error_rates,
+        eve_fraction=args.eve_fractions,
+        n_shots=args.n_shots,
+        threshold=args.thresholds,
+        num_cascade_iters=args.cascade_iters
+    )
+    n_runs = sweep(
+        grid, args.sweep_dir, args.n_bits, args.repeats, args.seed, args.workers
+    )
+    print(f'Wrote {n_runs} runs to {args.sweep_dir}')
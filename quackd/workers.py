@@ -0,0 +1,60 @@
+import signal
+import subprocess
+import sys
+import time
+
+from globals import *
+
+
+def supervise(n_workers, argv=None):
+    """
+    Runs n_workers copies of the current script, each with --worker_id set,
+    and restarts workers that exit abnormally until the supervisor is stopped.
+    Workers that keep crashing are restarted with exponential backoff.
+    """
+    argv = sys.argv if argv is None else argv
+
+    def spawn(worker_id):
+        return subprocess.Popen(
+            [sys.executable, *argv, '--worker_id', str(worker_id)]
+        )
+
+    # turn SIGTERM into SystemExit so that workers are terminated on the way out
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    workers = {i: spawn(i) for i in range(n_workers)}
+    started_at = {i: time.monotonic() for i in range(n_workers)}
+    backoff = {i: 0 for i in range(n_workers)}
+    # workers waiting to be restarted, mapped to when they are due
+    pending = {}
+    try:
+        while workers or pending:
+            time.sleep(WORKER_POLL_INTERVAL)
+            now = time.monotonic()
+            for worker_id, due in list(pending.items()):
+                if now >= due:
+                    del pending[worker_id]
+                    workers[worker_id] = spawn(worker_id)
+                    started_at[worker_id] = now
+            for worker_id, proc in list(workers.items()):
+                code = proc.poll()
+                if code is None:
+                    continue
+                del workers[worker_id]
+                if code == 0:
+                    continue
+                # a worker that ran for a while crashed for a new reason
+                if now - started_at[worker_id] >= WORKER_MAX_BACKOFF:
+                    backoff[worker_id] = 0
+                pending[worker_id] = now + backoff[worker_id]
+                backoff[worker_id] = min(
+                    max(2 * backoff[worker_id], WORKER_POLL_INTERVAL), WORKER_MAX_BACKOFF
+                )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in workers.values():
+            proc.terminate()
+        for proc in workers.values():
+            proc.wait()
+    return 0
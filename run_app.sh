@@ -8,15 +8,28 @@ SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 SLACK_TOKENS_PATH="${SCRIPT_DIR}/credentials/slack.json"
 QI_AUTH_PATH="${SCRIPT_DIR}/credentials/qi.json"
 KEYCHAIN_PATH="${SCRIPT_DIR}/data/keychain.json"
+CALIBRATION_DIR="${SCRIPT_DIR}/data/calibration"
 
-# Specify backend for B92 protocol
+# Specify backends for B92 protocol, in order of preference
 # Available options are "aer", "qi_sim", "qi_starmon"
-BACKEND="aer"
+# Jobs are routed by observed queue time and fail over between backends
+BACKENDS="aer"
+
+# Seconds after which distributed keys expire; leave empty to keep keys forever
+KEY_TTL=""
+
+# Number of worker processes, each holding its own Socket Mode connection
+# More than one worker requires an SQLite keychain, e.g. "${SCRIPT_DIR}/data/keychain.db",
+# and a calibration directory
+WORKERS=1
 
 eval "$(${CONDA_PATH} shell.bash hook)"
 conda activate ${CONDA_ENV}
 
 exec ${PYTHON_PATH} ${SCRIPT_DIR}/quackd/app.py \
-    ${SLACK_TOKENS_PATH} ${BACKEND} \
+    ${SLACK_TOKENS_PATH} ${BACKENDS} \
     --qi_auth_path ${QI_AUTH_PATH} \
-    --keychain_path ${KEYCHAIN_PATH}
+    --keychain_path ${KEYCHAIN_PATH} \
+    --calibration_dir ${CALIBRATION_DIR} \
+    --workers ${WORKERS} \
+    ${KEY_TTL:+--key_ttl ${KEY_TTL}}